@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 import requests
 import json
 import django_heroku
@@ -94,9 +96,55 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'cyfmazyr.wsgi.application'
 
+# Cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all workers of a host. MAX_ENTRIES has to stay above the
+    # number of active sessions, otherwise culling keeps dropping live ones.
+    # Set SESSION_CACHE_URL (e.g. to memcached) to share it between hosts.
+    'sessions': env.cache_url(
+        'SESSION_CACHE_URL',
+        default='filecache://' + os.path.join(tempfile.gettempdir(), 'cyfmazyr_sessions')
+        + '?max_entries=100000&cull_frequency=10',
+    ),
+}
+
+if sys.argv[1:2] == ['test']:
+    # Tests must neither read sessions of a development server nor leave
+    # their own behind.
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+    }
+
 # Sessions
 
-SESSION_ENGINE = 'users.backends.db'
+SESSION_ENGINE = 'users.backends.cached_db'
+
+SESSION_CACHE_ALIAS = 'sessions'
+
+SESSION_LOCAL_CACHE_SIZE = 1000
+
+SESSION_LOCAL_CACHE_TIMEOUT = 5
+
+# Seconds between last_activity/ip/user_agent updates of a session and, if
+# set, between background flushes of the collected updates
+
+SESSION_ACTIVITY_UPDATE_INTERVAL = 60
+
+SESSION_ACTIVITY_FLUSH_INTERVAL = None
+
+# Seconds between log records of the SessionMiddleware counters of a process,
+# None to not log them
+
+SESSION_STATS_LOG_INTERVAL = 600
+
+# Session payloads of at least this many bytes are stored compressed
+
+SESSION_COMPRESS_MIN_LENGTH = 1024
 
 SESSION_COOKIE_HTTPONLY = True
 
@@ -200,6 +248,11 @@ ADMIN_SHELL_ONLY_DEBUG_MODE = False
 
 GEOIP_PATH = os.path.join(BASE_DIR, "geoip")
 
+GEOIP_CACHE_SIZE = 10000
+
+# Seconds between checks whether the GeoIP database file was replaced
+GEOIP_RELOAD_INTERVAL = 60
+
 # Import/Export settings
 
 IMPORT_EXPORT_IMPORT_PERMISSION_CODE = "change"
@@ -228,5 +281,9 @@ LOGGING = {
 # Heroku setup
 
 django_heroku.settings(locals())
+LOGGING['loggers']['users.middleware'] = {
+    'handlers': ['console'],
+    'level': 'INFO',
+}
 db_from_env = dj_database_url.config(conn_max_age=0)
 DATABASES['default'].update(db_from_env)
@@ -1,9 +1,12 @@
 from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
 from django.urls import path
+from django.utils.html import format_html
+from django.utils.translation import ugettext as _
 
 from .forms import ScriptForm
-from .models import Backup, Script, School, University
+from .models import Backup, ExportJob, Script, School, University
+from .registry import get_content_types
 from .views import execute_script_view
 
 
@@ -19,15 +22,55 @@ class BackupAdmin(admin.ModelAdmin):
         form = super(BackupAdmin, self).get_form(request, obj, **kwargs)
         model = form.base_fields.get('model')
         if model:
-            existing_ids = []
-            for i in model.queryset:
-                if i.model_class():
-                    existing_ids.append(i.id)
-            model.queryset = ContentType.objects.filter(id__in=existing_ids)
+            model.queryset = ContentType.objects.filter(id__in=list(get_content_types()))
 
         return form
 
 
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('model', 'user', 'status', 'progress', 'created', 'download')
+    list_filter = ('status',)
+    list_select_related = ('model', 'user')
+    fields = ('model', 'user', 'file_format', 'status', 'progress', 'download', 'created', 'started', 'finished', 'error')
+    readonly_fields = fields
+
+    def get_queryset(self, request):
+        queryset = super(ExportJobAdmin, self).get_queryset(request)
+        if not request.user.is_superuser:
+            queryset = queryset.filter(user=request.user)
+        return queryset
+
+    def has_add_permission(self, request):
+        return False
+
+    # Staff who may export a model follow their own jobs without a
+    # permission on jobs, get_queryset() leaves them only their jobs.
+    def has_module_permission(self, request):
+        return request.user.is_staff
+
+    def has_view_permission(self, request, obj=None):
+        if obj is None or obj.user_id == request.user.pk:
+            return True
+        return super(ExportJobAdmin, self).has_view_permission(request, obj)
+
+    def progress(self, obj):
+        if obj.status == ExportJob.DONE:
+            return format_html('<progress value="1" max="1"></progress> {} rows', obj.processed)
+        if not obj.total:
+            return '-'
+        return format_html(
+            '<progress value="{}" max="{}"></progress> {} / {}', obj.processed, obj.total, obj.processed, obj.total
+        )
+    progress.short_description = _('Progress')
+
+    def download(self, obj):
+        if obj.status != ExportJob.DONE or not obj.file:
+            return '-'
+        return format_html('<a href="{}">{}</a>', obj.file.url, obj.file.name.rsplit('/', 1)[-1])
+    download.short_description = _('File')
+
+
 @admin.register(Script)
 class ScriptAdmin(admin.ModelAdmin):
     form = ScriptForm
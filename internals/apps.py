@@ -1,7 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 from django.utils.translation import ugettext_lazy as _
 
 
 class InternalsConfig(AppConfig):
     name = 'internals'
     verbose_name = _('Internals')
+
+    def ready(self):
+        from .registry import clear_cache
+        post_migrate.connect(clear_cache)
@@ -0,0 +1,556 @@
+"""
+Backups of model data into one file per model and day.
+
+Every model is queried once for the whole date range, ordered by its date
+field, and the rows are streamed into the file of their day while the
+queryset is being iterated, so memory use doesn't depend on the number of
+rows. Foreign keys are joined to the query and many-to-many fields are
+prefetched once per chunk of rows.
+
+Files are CSV, optionally compressed with gzip or zstd, or Parquet. Each
+run writes a JSON manifest with the row count, size and SHA-256 checksum of
+its files, which are also stored on the Backup records.
+
+Files are stored by checksum under blobs/, a file with the content of an
+earlier backup isn't uploaded again and its Backup record points to the
+existing blob. Blobs no longer referenced are deleted by gcbackups.
+"""
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, models
+from django.utils import timezone
+
+from .models import Backup
+from .registry import get_registry, get_resource
+from .resources import iter_chunks, with_relations
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def get_backup_models():
+    """
+    Returns (content type, model, date field) of every model to back up.
+    """
+    return [(entry.content_type, entry.model, entry.date_field) for entry in get_registry()]
+
+
+def get_day(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+def get_range_filter(model, date_field, start_date, end_date):
+    """
+    Filter of the dates [start_date, end_date) as a plain range on the
+    column, so an index on the date field can be used.
+    """
+    if isinstance(model._meta.get_field(date_field), models.DateTimeField):
+        start_date, end_date = (
+            datetime.datetime.combine(date, datetime.time.min) for date in (start_date, end_date)
+        )
+        if settings.USE_TZ:
+            start_date, end_date = timezone.make_aware(start_date), timezone.make_aware(end_date)
+    return {f"{date_field}__gte": start_date, f"{date_field}__lt": end_date}
+
+
+class CSVWriter(object):
+    """
+    Writes rows as UTF-8 CSV into a binary file, compressed by subclasses.
+    """
+    def __init__(self, file, headers):
+        self._file = file
+        self._stream = self.open(file)
+        self._text = io.TextIOWrapper(self._stream, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(headers)
+
+    def open(self, file):
+        return file
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._text.flush()
+        self._text.detach()
+        if self._stream is not self._file:
+            # Ends the compressed stream, the file itself stays open.
+            self._stream.close()
+
+
+class GzipCSVWriter(CSVWriter):
+    def open(self, file):
+        # No name and timestamp in the header, equal data gives equal files.
+        return gzip.GzipFile(filename='', mode='wb', fileobj=file, mtime=0)
+
+
+class ZstdCSVWriter(CSVWriter):
+    def open(self, file):
+        return zstandard.ZstdCompressor().stream_writer(file, closefd=False)
+
+
+class ParquetWriter(object):
+    """
+    Writes rows as a Parquet file of string columns, in row groups of
+    ``batch_size`` rows.
+    """
+    batch_size = 10000
+
+    def __init__(self, file, headers):
+        self._schema = pyarrow.schema([(header, pyarrow.string()) for header in headers])
+        self._writer = pyarrow.parquet.ParquetWriter(file, self._schema, compression='zstd')
+        self._rows = []
+
+    def writerow(self, row):
+        self._rows.append([None if value is None else str(value) for value in row])
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        columns = list(zip(*self._rows)) or [[] for name in self._schema.names]
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, pyarrow.string()) for column in columns], schema=self._schema
+        ))
+        self._rows = []
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        self._writer.close()
+
+
+FORMATS = {
+    'csv': CSVWriter,
+    'csv.gz': GzipCSVWriter,
+    'csv.zst': ZstdCSVWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def get_available_formats():
+    formats = ['csv', 'csv.gz']
+    if zstandard:
+        formats.append('csv.zst')
+    if pyarrow:
+        formats.append('parquet')
+    return formats
+
+
+def get_format(name):
+    """
+    Returns the format of a backup file from its name.
+    """
+    for format in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith(f'.{format}'):
+            return format
+    raise ValueError(f"Unknown backup format of '{name}'")
+
+
+def read_rows(file, name):
+    """
+    Yields the rows of a backup file, the header first.
+    """
+    format = get_format(name)
+    if format == 'parquet':
+        parquet = pyarrow.parquet.ParquetFile(file)
+        yield parquet.schema_arrow.names
+        for batch in parquet.iter_batches():
+            yield from (list(row) for row in zip(*(column.to_pylist() for column in batch.columns)))
+        return
+    if format == 'csv.gz':
+        file = gzip.GzipFile(fileobj=file, mode='rb')
+    elif format == 'csv.zst':
+        file = zstandard.ZstdDecompressor().stream_reader(file, closefd=False)
+    yield from csv.reader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+
+
+def hash_file(file, chunk_size=1024 * 1024):
+    """
+    Returns the size and SHA-256 hex digest of a binary file, read from its
+    current position.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+    return size, sha256.hexdigest()
+
+
+class DayFile(object):
+    """
+    Backup file of one day, spooled to a temporary file on disk.
+    """
+    def __init__(self, date, headers, format='csv', kind=Backup.DAILY):
+        self.date = date
+        self.format = format
+        self.kind = kind
+        self.watermark = None
+        self.rows = 0
+        self.size = None
+        self.sha256 = None
+        self.file = tempfile.TemporaryFile()
+        self._writer = FORMATS[format](self.file, headers)
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+        self.rows += 1
+
+    def finish(self):
+        """
+        Completes the file, computes its size and checksum and returns the
+        underlying binary file, rewound.
+        """
+        self._writer.close()
+        self.file.seek(0)
+        self.size, self.sha256 = hash_file(self.file)
+        self.file.seek(0)
+        return self.file
+
+
+def iter_objects(queryset, chunk_size):
+    for chunk in iter_chunks(queryset, chunk_size):
+        yield from chunk
+
+
+def export_days(model, date_field, start_date, end_date, chunk_size=2000, format='csv'):
+    """
+    Yields the DayFile of every day of [start_date, end_date), days
+    without rows included, exporting the model with a single query and a
+    query per chunk and many-to-many field.
+    """
+    resource = get_resource(model)
+    headers = resource.get_export_headers()
+    queryset = model._default_manager.filter(
+        **get_range_filter(model, date_field, start_date, end_date)
+    ).order_by(date_field, model._meta.pk.name)
+
+    day = DayFile(start_date, headers, format)
+    for obj in iter_objects(with_relations(resource, queryset), chunk_size):
+        date = get_day(getattr(obj, date_field))
+        while date > day.date:
+            yield day
+            day = DayFile(day.date + datetime.timedelta(days=1), headers, format)
+        day.writerow(resource.export_resource(obj))
+    while True:
+        yield day
+        if day.date + datetime.timedelta(days=1) >= end_date:
+            break
+        day = DayFile(day.date + datetime.timedelta(days=1), headers, format)
+
+
+def get_history_models():
+    """
+    Returns (content type, model) of every simple_history model to back up.
+    """
+    return [
+        (content_type, model) for content_type, model, date_field in get_backup_models()
+        if date_field == 'history_date' and hasattr(model, 'history_id')
+    ]
+
+
+def get_watermark(content_type):
+    """
+    Returns the last history_id of the model saved by an incremental backup.
+    """
+    return Backup.objects.filter(
+        model=content_type, kind=Backup.INCREMENTAL
+    ).aggregate(watermark=models.Max('watermark'))['watermark']
+
+
+def export_changes(model, since, until, chunk_size=2000, format='csv'):
+    """
+    Yields a file of the historical rows after the history_id ``since`` (all
+    if None) recorded up to the datetime ``until``, or nothing if there are
+    none. Its watermark is the last exported history_id.
+
+    Rows are read in history_id order, so the primary key index bounds the
+    scan. The export stops at the first row after ``until`` instead of
+    filtering on it: ids are allocated before the transaction commits, a
+    later run must not skip rows of transactions still open now.
+    """
+    resource = get_resource(model)
+    queryset = model._default_manager.order_by('history_id')
+    if since is not None:
+        queryset = queryset.filter(history_id__gt=since)
+
+    day = DayFile(timezone.localdate(until), resource.get_export_headers(), format, Backup.INCREMENTAL)
+    for obj in iter_objects(with_relations(resource, queryset), chunk_size):
+        if obj.history_date > until:
+            break
+        day.writerow(resource.export_resource(obj))
+        day.watermark = obj.history_id
+    if day.rows:
+        yield day
+
+
+class BackupResult(object):
+    """
+    Outcome of the backup of one model and day.
+    """
+    def __init__(self, content_type, date, rows, size=0, sha256=None, backup=None, error=None, deduplicated=False):
+        self.content_type = content_type
+        self.date = date
+        self.rows = rows
+        self.size = size
+        self.sha256 = sha256
+        self.backup = backup
+        self.error = error
+        # The blob already existed and wasn't uploaded
+        self.deduplicated = deduplicated
+
+
+def upload_file(day, content_type, storage=None, retries=3, backoff=1.0):
+    """
+    Uploads a finished DayFile to the storage, retrying failed attempts with
+    exponential backoff, and returns an unsaved Backup pointing to it and
+    whether the file was uploaded. Nothing is uploaded if a blob with the
+    same checksum exists.
+    """
+    storage = storage or default_storage
+    file = day.file
+    backup = Backup(
+        model=content_type, date=day.date, kind=day.kind, watermark=day.watermark,
+        rows=day.rows, size=day.size, sha256=day.sha256,
+    )
+    name = Backup._meta.get_field('file').generate_filename(backup, f"{day.date}.{day.format}")
+    for attempt in range(retries + 1):
+        try:
+            if storage.exists(name):
+                backup.file.name = name
+                return backup, False
+            file.seek(0)
+            backup.file.name = storage.save(name, File(file))
+            return backup, True
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+class BackupRunner(object):
+    """
+    Exports models and uploads their day files concurrently.
+
+    Up to ``jobs`` models are exported at a time, each in its own thread with
+    its own database connection, and their day files are uploaded by up to
+    ``jobs`` other threads while the export goes on. At most ``2 * jobs``
+    finished files wait for an upload, so disk use stays bounded. Backup
+    records of uploaded files are created in bulk at the end. Uploads of
+    files with the same checksum run one after the other, so the later ones
+    find the blob and are skipped.
+    """
+    def __init__(self, jobs=1, storage=None, retries=3, chunk_size=2000, format='csv', create_records=True):
+        self.jobs = jobs
+        self.storage = storage
+        self.format = format
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.create_records = create_records
+        self.manifest = None
+        self._slots = threading.BoundedSemaphore(2 * jobs)
+        self._lock = threading.Lock()
+        self._blob_locks = {}
+
+    def run(self, backup_models, start_date, end_date):
+        """
+        Returns a BackupResult for every model and day of [start_date, end_date).
+        """
+        return self._run([
+            (content_type, partial(
+                export_days, model, date_field, start_date, end_date, self.chunk_size, self.format
+            ))
+            for content_type, model, date_field in backup_models
+        ])
+
+    def run_incremental(self, history_models, until):
+        """
+        Backs up the historical rows recorded since the watermark of the last
+        incremental backup of each model, up to ``until``. Returns a
+        BackupResult for every model with changes.
+        """
+        return self._run([
+            (content_type, partial(
+                export_changes, model, get_watermark(content_type), until, self.chunk_size, self.format
+            ))
+            for content_type, model in history_models
+        ])
+
+    def _run(self, exports):
+        uploads = []
+        with ThreadPoolExecutor(self.jobs, thread_name_prefix='backup-upload') as upload_executor:
+            with ThreadPoolExecutor(self.jobs, thread_name_prefix='backup-export') as export_executor:
+                exports = [
+                    export_executor.submit(self.export, upload_executor, content_type, export)
+                    for content_type, export in exports
+                ]
+                for future in exports:
+                    uploads.extend(future.result())
+            results = [future.result() for future in uploads]
+        if self.create_records:
+            Backup.objects.bulk_create(result.backup for result in results if result.backup)
+            self.manifest = write_manifest(results, self.storage)
+        return results
+
+    def export(self, executor, content_type, export):
+        futures = []
+        try:
+            for day in export():
+                self._slots.acquire()
+                future = executor.submit(self.upload, content_type, day)
+                future.add_done_callback(lambda future: self._slots.release())
+                futures.append(future)
+        except Exception as e:
+            # Files of the days exported so far are still uploaded.
+            failed = Future()
+            failed.set_result(BackupResult(content_type, None, 0, error=e))
+            futures.append(failed)
+        finally:
+            connection.close()
+        return futures
+
+    def upload(self, content_type, day):
+        with day.finish():
+            with self._lock:
+                blob_lock = self._blob_locks.setdefault(day.sha256, threading.Lock())
+            try:
+                with blob_lock:
+                    backup, uploaded = upload_file(day, content_type, self.storage, self.retries)
+            except Exception as e:
+                return BackupResult(content_type, day.date, day.rows, day.size, day.sha256, error=e)
+        return BackupResult(
+            content_type, day.date, day.rows, day.size, day.sha256, backup=backup, deduplicated=not uploaded
+        )
+
+
+def write_manifest(results, storage=None):
+    """
+    Saves the list of uploaded files of a run as JSON next to the backups
+    and returns its name.
+    """
+    storage = storage or default_storage
+    created = timezone.now()
+    manifest = {
+        'created': created.isoformat(),
+        'files': [
+            {
+                'model': f"{result.content_type.app_label}.{result.content_type.model}",
+                'date': result.date.isoformat(),
+                'kind': result.backup.kind,
+                'watermark': result.backup.watermark,
+                'name': result.backup.file.name,
+                'rows': result.rows,
+                'size': result.size,
+                'sha256': result.sha256,
+            }
+            for result in results if result.backup
+        ],
+    }
+    content = ContentFile(json.dumps(manifest, indent=2).encode('utf-8'))
+    return storage.save(f"manifests/{created:%Y-%m-%d-%H-%M-%S}.json", content)
+
+
+def get_expired_backups(today, keep_daily, keep_weekly, keep_incremental=None):
+    """
+    Returns the pks of the backups outside the retention policy: daily
+    backups are kept for ``keep_daily`` days, then only the last backed up
+    day of each week and model is kept for ``keep_weekly`` weeks.
+    Incremental backups are kept for ``keep_incremental`` days, or forever
+    if None, as every one of them is needed to restore the changes.
+    """
+    daily_since = today - datetime.timedelta(days=keep_daily)
+    weekly_since = today - datetime.timedelta(weeks=keep_weekly)
+    expired = []
+    weeks = {}
+    backups = Backup.objects.filter(kind=Backup.DAILY, date__lt=daily_since).values_list('pk', 'model_id', 'date')
+    for pk, model_id, date in backups.iterator():
+        if date < weekly_since:
+            expired.append(pk)
+        else:
+            weeks.setdefault((model_id, date.isocalendar()[:2]), []).append((date, pk))
+    for backups in weeks.values():
+        last = max(date for date, pk in backups)
+        expired.extend(pk for date, pk in backups if date != last)
+    if keep_incremental is not None:
+        expired.extend(Backup.objects.filter(
+            kind=Backup.INCREMENTAL, date__lt=today - datetime.timedelta(days=keep_incremental)
+        ).values_list('pk', flat=True))
+    return expired
+
+
+def get_unreferenced(names, batch_size=1000):
+    """
+    Returns the file names no Backup refers to.
+    """
+    names = list(names)
+    referenced = set()
+    for start in range(0, len(names), batch_size):
+        referenced.update(Backup.objects.filter(
+            file__in=names[start:start + batch_size]
+        ).values_list('file', flat=True))
+    return [name for name in names if name not in referenced]
+
+
+def list_blobs(storage=None):
+    """
+    Yields the names of all blobs in the storage.
+    """
+    storage = storage or default_storage
+    try:
+        directories, files = storage.listdir('blobs')
+    except FileNotFoundError:
+        return
+    for directory in directories:
+        for name in storage.listdir(f"blobs/{directory}")[1]:
+            yield f"blobs/{directory}/{name}"
+
+
+def delete_files(names, storage=None, jobs=1, batch_size=100):
+    """
+    Deletes files from the storage, batches of ``batch_size`` names by up to
+    ``jobs`` threads, and returns (deleted, [(name, error)]).
+    """
+    storage = storage or default_storage
+
+    def delete_batch(batch):
+        deleted, errors = 0, []
+        for name in batch:
+            try:
+                storage.delete(name)
+                deleted += 1
+            except Exception as e:
+                errors.append((name, e))
+        return deleted, errors
+
+    names = list(names)
+    batches = [names[start:start + batch_size] for start in range(0, len(names), batch_size)]
+    deleted, errors = 0, []
+    with ThreadPoolExecutor(jobs, thread_name_prefix='backup-delete') as executor:
+        for batch_deleted, batch_errors in executor.map(delete_batch, batches):
+            deleted += batch_deleted
+            errors.extend(batch_errors)
+    return deleted, errors
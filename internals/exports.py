@@ -0,0 +1,290 @@
+"""
+Admin exports streamed or run in the background.
+
+import_export builds a tablib Dataset of all rows and serializes it at once,
+memory grows with the number of rows. CSV and JSON lines exports of
+BackgroundExportMixin admins are streamed instead: the queryset is iterated
+in chunks and every chunk of rows is written out before the next one is
+fetched, so memory stays bounded by the chunk size. The relations the
+resource exports are joined and prefetched per chunk.
+
+Other formats need the whole dataset. Instead of building the file inside
+the request, the export view and the export admin action queue an ExportJob
+with the changelist filters and the selected pks of the rows to export, the
+worker builds the queryset from them with the model admin as the changelist
+does. The runexportworker command
+picks jobs up one at a time, records their progress while exporting and
+saves the file to DEFAULT_FILE_STORAGE, the admin of the job links to it
+when done.
+"""
+import csv
+import json
+import tempfile
+import traceback
+
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpRequest, HttpResponseRedirect, QueryDict, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+import tablib
+from import_export.formats import base_formats
+from import_export.forms import ExportForm
+from import_export.signals import post_export
+
+from .models import ExportJob
+from .resources import iter_chunks, with_relations
+
+
+class Echo(object):
+    """
+    File-like object returning what is written to it, lets csv.writer
+    format rows for a generator.
+    """
+    def write(self, value):
+        return value
+
+
+def iter_rows(resource, queryset, chunk_size=500, progress=None):
+    """
+    Yields the exported rows of a queryset, fetched ``chunk_size`` at a time,
+    calling ``progress`` with the number of rows after every chunk. There is
+    no dataset, so the after_export() hook of the resource isn't called.
+    """
+    resource.before_export(queryset)
+    queryset = with_relations(resource, queryset)
+    count = 0
+    for chunk in iter_chunks(queryset, chunk_size):
+        for obj in chunk:
+            yield resource.export_resource(obj)
+        count += len(chunk)
+        if progress:
+            progress(count)
+
+
+def stream_csv(headers, rows, chunk_size=500):
+    """
+    Yields UTF-8 CSV of the rows, ``chunk_size`` rows at a time.
+    """
+    writer = csv.writer(Echo())
+    lines = [writer.writerow(headers)]
+    for row in rows:
+        lines.append(writer.writerow(row))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+    yield ''.join(lines).encode('utf-8')
+
+
+def stream_jsonl(headers, rows, chunk_size=500):
+    """
+    Yields JSON lines of the rows, an object by header per row.
+    """
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+    yield ''.join(lines).encode('utf-8')
+
+
+class JSONL(base_formats.Format):
+    """
+    JSON lines export format, only written by stream_jsonl.
+    """
+    def get_title(self):
+        return 'jsonl'
+
+    def get_extension(self):
+        return 'jsonl'
+
+    def get_content_type(self):
+        return 'application/x-ndjson'
+
+    def can_export(self):
+        return True
+
+    def export_data(self, dataset, **kwargs):
+        return b''.join(stream_jsonl(dataset.headers, dataset))
+
+
+STREAMING_FORMATS = {
+    'csv': stream_csv,
+    'jsonl': stream_jsonl,
+}
+
+
+def claim_job():
+    """
+    Marks the oldest pending job as running and returns it, or None. Jobs
+    locked by other workers are skipped.
+    """
+    with transaction.atomic():
+        job = ExportJob.objects.select_for_update(skip_locked=True).filter(
+            status=ExportJob.PENDING
+        ).order_by('created', 'pk').first()
+        if job is not None:
+            job.status = ExportJob.RUNNING
+            job.started = timezone.now()
+            job.save(update_fields=['status', 'started'])
+    return job
+
+
+def get_export_format(modeladmin, name):
+    for file_format in modeladmin.get_export_formats():
+        if file_format().get_title() == name:
+            return file_format()
+    raise ValueError(f"Unknown export format '{name}'")
+
+
+def get_job_queryset(modeladmin, job):
+    """
+    Returns the rows of a job: the export queryset of the model admin for
+    the changelist filters of the job, limited to the selected pks if any.
+    """
+    query = json.loads(job.query)
+    request = HttpRequest()
+    request.user = job.user or AnonymousUser()
+    request.GET = QueryDict(mutable=True)
+    for name, values in query['filters'].items():
+        request.GET.setlist(name, values)
+    queryset = modeladmin.get_export_queryset(request)
+    if query['pks'] is not None:
+        queryset = queryset.filter(pk__in=query['pks'])
+    return queryset
+
+
+def run_job(job, chunk_size=500):
+    """
+    Exports the rows of a job with the resource of the model admin and
+    saves the file. The job is requeued if the worker is stopped meanwhile.
+    """
+    try:
+        model = job.model.model_class()
+        modeladmin = admin.site._registry[model]
+        file_format = get_export_format(modeladmin, job.file_format)
+        resource = modeladmin.get_export_resource_class()(**modeladmin.get_export_resource_kwargs(None))
+        queryset = get_job_queryset(modeladmin, job)
+
+        job.total = queryset.count()
+        job.save(update_fields=['total'])
+
+        def progress(processed):
+            job.processed = processed
+            ExportJob.objects.filter(pk=job.pk).update(processed=processed)
+
+        name = modeladmin.get_export_filename(None, queryset, file_format)
+        rows = iter_rows(resource, queryset, chunk_size, progress)
+        stream = STREAMING_FORMATS.get(file_format.get_title())
+        if stream:
+            with tempfile.TemporaryFile() as file:
+                for chunk in stream(resource.get_export_headers(), rows, chunk_size):
+                    file.write(chunk)
+                file.seek(0)
+                job.file.save(name, File(file), save=False)
+        else:
+            data = tablib.Dataset(*rows, headers=resource.get_export_headers())
+            resource.after_export(queryset, data)
+            content = file_format.export_data(data)
+            if isinstance(content, str):
+                content = content.encode(modeladmin.to_encoding)
+            job.file.save(name, ContentFile(content), save=False)
+        job.status = ExportJob.DONE
+        post_export.send(sender=None, model=model)
+    except Exception:
+        job.status = ExportJob.FAILED
+        job.error = traceback.format_exc()
+    except BaseException:
+        ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.PENDING, started=None, processed=0)
+        raise
+    job.finished = timezone.now()
+    job.save(update_fields=['file', 'processed', 'status', 'error', 'finished'])
+    return job
+
+
+class BackgroundExportMixin(object):
+    """
+    ExportMixin or ExportActionMixin admin mixin streaming CSV and JSON
+    lines exports and queueing exports of other formats as ExportJobs.
+    """
+    #: rows fetched from the database at a time by streamed exports
+    export_chunk_size = 500
+
+    def get_export_formats(self):
+        return super(BackgroundExportMixin, self).get_export_formats() + [JSONL]
+
+    def export(self, request, queryset, file_format, pks=None):
+        """
+        Streams or queues the export of the queryset, which is the export
+        queryset of the changelist filtered to ``pks`` if given.
+        """
+        if file_format.get_title() in STREAMING_FORMATS:
+            return self.stream_export(request, queryset, file_format)
+        return self.queue_export(request, file_format, pks)
+
+    def stream_export(self, request, queryset, file_format):
+        resource = self.get_export_resource_class()(**self.get_export_resource_kwargs(request))
+        rows = iter_rows(resource, queryset, self.export_chunk_size)
+        response = StreamingHttpResponse(
+            STREAMING_FORMATS[file_format.get_title()](resource.get_export_headers(), rows, self.export_chunk_size),
+            content_type=file_format.get_content_type(),
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (
+            self.get_export_filename(request, queryset, file_format),
+        )
+        post_export.send(sender=None, model=self.model)
+        return response
+
+    def queue_export(self, request, file_format, pks=None):
+        job = ExportJob.objects.create(
+            model=ContentType.objects.get_for_model(self.model),
+            user=request.user,
+            query=json.dumps({'filters': dict(request.GET.lists()), 'pks': pks}),
+            file_format=file_format.get_title(),
+        )
+        messages.info(request, _('The export was queued, download the file here when it is done.'))
+        return HttpResponseRedirect(reverse('admin:internals_exportjob_change', args=[job.pk]))
+
+    def export_action(self, request, *args, **kwargs):
+        if request.method != 'POST':
+            return super(BackgroundExportMixin, self).export_action(request, *args, **kwargs)
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+        formats = self.get_export_formats()
+        form = ExportForm(formats, request.POST)
+        if not form.is_valid():
+            return super(BackgroundExportMixin, self).export_action(request, *args, **kwargs)
+        file_format = formats[int(form.cleaned_data['file_format'])]()
+        return self.export(request, self.get_export_queryset(request), file_format)
+
+    def get_actions(self, request):
+        actions = super(BackgroundExportMixin, self).get_actions(request)
+        if 'export_admin_action' in actions:
+            # ExportActionMixin lists its own function in actions.
+            func, name, description = actions['export_admin_action']
+            actions['export_admin_action'] = (type(self).export_admin_action, name, description)
+        return actions
+
+    def export_admin_action(self, request, queryset):
+        export_format = request.POST.get('file_format')
+        if not export_format:
+            messages.warning(request, _('You must select an export format.'))
+            return
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+        file_format = self.get_export_formats()[int(export_format)]()
+        pks = None
+        if not int(request.POST.get('select_across', 0)):
+            pks = request.POST.getlist(helpers.ACTION_CHECKBOX_NAME)
+        return self.export(request, queryset, file_format, pks)
+    export_admin_action.short_description = _('Export selected %(verbose_name_plural)s')
@@ -1,15 +1,15 @@
-from django.contrib import admin
-from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from import_export import resources
-
+from internals.backups import BackupRunner, get_available_formats, get_backup_models, get_history_models
 from internals.models import Backup
+from internals.registry import get_registry
 
 import argparse
 import datetime
+import time
 
 
 def valid_date(s):
@@ -36,8 +36,56 @@ class Command(BaseCommand):
             help="The End Date - format YYYY-MM-DD (not inclusive)", 
             type=valid_date
         )
+        parser.add_argument(
+            "--mode",
+            default="stream",
+            choices=["stream", "daily", "incremental"],
+            help=(
+                "stream: one query per model over the whole range, split into days while writing, "
+                "daily: one query per model and day, "
+                "incremental: historical rows changed since the last incremental backup (dates are ignored)"
+            )
+        )
+        parser.add_argument(
+            "--lag",
+            default=60,
+            type=int,
+            help="Seconds of recent changes left for the next incremental backup, so open transactions aren't skipped"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            default=2000,
+            type=int,
+            help="Number of rows fetched from the database at a time in stream mode"
+        )
+        parser.add_argument(
+            "--format",
+            default="csv.gz",
+            choices=get_available_formats(),
+            help="File format of the backups in stream mode"
+        )
+        parser.add_argument(
+            "--jobs",
+            default=1,
+            type=int,
+            help="Number of models exported and files uploaded concurrently in stream mode"
+        )
+        parser.add_argument(
+            "--retries",
+            default=3,
+            type=int,
+            help="Number of times a failed upload is retried"
+        )
+        parser.add_argument(
+            "--storage",
+            default=None,
+            help="Dotted path of a storage class to upload to instead of DEFAULT_FILE_STORAGE"
+        )
 
     def handle(self, *args, **options):
+        if options["mode"] == "incremental":
+            return self.handle_incremental(options)
+
         start_date = options["startdate"].date()
         end_date = options["enddate"].date()
         cur_date = timezone.now().date()
@@ -49,29 +97,16 @@ class Command(BaseCommand):
         if start_date > (timezone.now() - datetime.timedelta(days=1)).date():
             raise CommandError("startdate can't start from today or future")
 
-        existing_ct_ids = []
-        for i in ContentType.objects.all():
-            if i.app_label in ["admin", "auth", "contenttypes", "sessions", "internals"]:
-                continue
-            if i.model_class():
-                existing_ct_ids.append(i.id)
-        content_types = ContentType.objects.filter(id__in=existing_ct_ids)
+        if options["mode"] == "stream":
+            return self.handle_stream(start_date, end_date, options)
 
         day_count = (end_date - start_date).days
         for date in (start_date + datetime.timedelta(n) for n in range(day_count)):
             self.stdout.write(f"Backuping {date}")
-            for content_type in content_types:
-                model = content_type.model_class()
-                resource = resources.modelresource_factory(model=model)()
-                modeladmin = admin.site._registry.get(model)
-                date_hierarchy = getattr(modeladmin, 'date_hierarchy', '')
-                if not date_hierarchy:
-                    if content_type.model.startswith('historical'):
-                        date_hierarchy = "history_date"
-                    else:
-                        continue
-
-                self.stdout.write(f"  - backuping {content_type.app_label}.{content_type.model}")
+            for entry in get_registry():
+                content_type, model, date_hierarchy = entry.content_type, entry.model, entry.date_field
+
+                self.stdout.write(f"  - backuping {entry.label}")
 
                 self.stdout.write(f"    - querying database")
                 queryset = model.objects.filter(**{
@@ -80,9 +115,61 @@ class Command(BaseCommand):
                 })
                 
                 self.stdout.write(f"    - exporting data to csv")
-                dataset = resource.export(queryset)
+                dataset = entry.resource.export(queryset)
                 
                 self.stdout.write(f"    - creating backup")
                 backup = Backup(model=content_type, date=date)
-                backup.file.save("test.csv", ContentFile(dataset.csv.encode('utf-8')))
+                backup.file.save(f"{date}.csv", ContentFile(dataset.csv.encode('utf-8')))
                 backup.save()
+
+    def get_runner(self, options):
+        storage = import_string(options["storage"])() if options["storage"] else None
+        return BackupRunner(
+            jobs=options["jobs"],
+            storage=storage,
+            retries=options["retries"],
+            chunk_size=options["chunk_size"],
+            format=options["format"],
+        )
+
+    def handle_incremental(self, options):
+        runner = self.get_runner(options)
+        until = timezone.now() - datetime.timedelta(seconds=options["lag"])
+        started = time.monotonic()
+        results = runner.run_incremental(get_history_models(), until)
+        self.report(runner, results, time.monotonic() - started, options)
+
+    def handle_stream(self, start_date, end_date, options):
+        runner = self.get_runner(options)
+        started = time.monotonic()
+        results = runner.run(get_backup_models(), start_date, end_date)
+        self.report(runner, results, time.monotonic() - started, options)
+
+    def report(self, runner, results, elapsed, options):
+        failed = [result for result in results if result.error]
+        for result in failed:
+            self.stderr.write(
+                f"  - {result.content_type.app_label}.{result.content_type.model} {result.date or ''}: {result.error}"
+            )
+        uploaded = [result for result in results if not result.error]
+        models = {}
+        for result in uploaded:
+            label = f"{result.content_type.app_label}.{result.content_type.model}"
+            files, rows, size = models.get(label, (0, 0, 0))
+            models[label] = (files + 1, rows + result.rows, size + result.size)
+        for label, (files, rows, size) in sorted(models.items()):
+            self.stdout.write(f"  - {label}: {files} files, {rows} rows, {size / 1024:.1f} KiB")
+        rows = sum(result.rows for result in uploaded)
+        size = sum(result.size for result in uploaded)
+        deduplicated = [result for result in uploaded if result.deduplicated]
+        self.stdout.write(
+            f"Backed up {len(uploaded)} files, {rows} rows, {size / 1024:.1f} KiB "
+            f"in {elapsed:.1f}s with {options['jobs']} jobs, {len(failed)} failed"
+        )
+        self.stdout.write(
+            f"{len(deduplicated)} files unchanged and not uploaded "
+            f"({sum(result.size for result in deduplicated) / 1024:.1f} KiB)"
+        )
+        self.stdout.write(f"Manifest: {runner.manifest}")
+        if failed:
+            raise CommandError(f"{len(failed)} backups failed")
@@ -0,0 +1,91 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from internals.backups import BackupRunner, get_backup_models
+
+import datetime
+import threading
+import time
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps files in a dict, every save takes ``latency`` seconds to stand in
+    for the round trip to a remote storage.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def _save(self, name, content):
+        data = content.read()
+        time.sleep(self.latency)
+        with self._lock:
+            self.files[name] = data
+        return name
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name], name=name)
+
+    def get_available_name(self, name, max_length=None):
+        # Files are overwritten, as with GoogleCloudStorage.
+        return name
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        with self._lock:
+            self.files.pop(name, None)
+
+    def size(self, name):
+        return len(self.files[name])
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the backup export and upload with different numbers of jobs (no Backup records are created)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--jobs",
+            default="1,2,4,8,16",
+            help="Comma separated numbers of jobs to run the backup with"
+        )
+        parser.add_argument(
+            "--days",
+            default=7,
+            type=int,
+            help="Number of days before today to back up"
+        )
+        parser.add_argument(
+            "--latency",
+            default=0.05,
+            type=float,
+            help="Seconds every upload to the in-memory storage takes"
+        )
+
+    def handle(self, *args, **options):
+        end_date = timezone.localdate()
+        start_date = end_date - datetime.timedelta(days=options["days"])
+        backup_models = get_backup_models()
+        self.stdout.write(
+            f"{len(backup_models)} models, {options['days']} days, {options['latency'] * 1000:.0f} ms per upload"
+        )
+        baseline = None
+        for jobs in (int(jobs) for jobs in options["jobs"].split(',')):
+            storage = MemoryStorage(options["latency"])
+            runner = BackupRunner(jobs=jobs, storage=storage, create_records=False)
+            started = time.perf_counter()
+            results = runner.run(backup_models, start_date, end_date)
+            elapsed = time.perf_counter() - started
+            failed = [result for result in results if result.error]
+            if failed:
+                raise CommandError(f"{len(failed)} backups failed: {failed[0].error}")
+            baseline = baseline or elapsed
+            self.stdout.write(
+                f"  - {jobs:2} jobs: {elapsed:.2f}s, {len(results) / elapsed:.1f} files/s, "
+                f"speedup {baseline / elapsed:.1f}x"
+            )
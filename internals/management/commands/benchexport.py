@@ -0,0 +1,103 @@
+from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from internals.exports import STREAMING_FORMATS, iter_rows
+
+import time
+import tracemalloc
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares peak memory of exporting a model with import_export's Dataset against the streamed export, "
+        "and fails if the streamed export exceeds --max-memory or if its queries grow with the number of rows"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model",
+            default="users.user",
+            help="Model to export (app_label.model), exported with the resource of its admin"
+        )
+        parser.add_argument(
+            "--format",
+            default="csv",
+            choices=sorted(STREAMING_FORMATS),
+            help="Streamed format"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            default=500,
+            type=int,
+            help="Number of rows fetched and written at a time"
+        )
+        parser.add_argument(
+            "--max-memory",
+            default=16,
+            type=float,
+            help="MiB the streamed export may allocate at most"
+        )
+
+    def handle(self, *args, **options):
+        model = ContentType.objects.get_by_natural_key(*options["model"].split('.')).model_class()
+        modeladmin = admin.site._registry.get(model)
+        if modeladmin is None or not hasattr(modeladmin, 'get_export_resource_class'):
+            raise CommandError(f"{options['model']} has no export admin")
+        resource_class = modeladmin.get_export_resource_class()
+        queryset = model._default_manager.order_by('pk')
+        self.stdout.write(f"{queryset.count()} rows of {options['model']}")
+
+        def dataset():
+            data = resource_class().export(queryset)
+            yield (data.csv if options["format"] == "csv" else data.json).encode('utf-8')
+
+        def streamed():
+            resource = resource_class()
+            rows = iter_rows(resource, queryset, options["chunk_size"])
+            yield from STREAMING_FORMATS[options["format"]](resource.get_export_headers(), rows, options["chunk_size"])
+
+        self.measure("Dataset", dataset)
+        peak = self.measure("streamed", streamed)
+        if peak > options["max_memory"] * 1024 * 1024:
+            raise CommandError(f"Streamed export used {peak / 1024 / 1024:.1f} MiB, more than {options['max_memory']} MiB")
+
+        # One chunk for all rows, the queries of a chunk mustn't depend on its rows.
+        count = max(queryset.count(), 1)
+        queries = self.count_queries(resource_class, queryset[:1], count)
+        all_queries = self.count_queries(resource_class, queryset, count)
+        self.stdout.write(f"Queries: {queries} for 1 row, {all_queries} for {count} rows")
+        if all_queries != queries:
+            raise CommandError(f"Exporting {count} rows ran {all_queries - queries} queries more than 1 row")
+
+    def count_queries(self, resource_class, queryset, chunk_size):
+        """
+        Returns the number of queries of a streamed export of the queryset.
+        """
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            for row in iter_rows(resource_class(), queryset, chunk_size):
+                pass
+        return len(queries)
+
+    def measure(self, name, export):
+        """
+        Consumes an export like a response would and returns its peak
+        memory allocation in bytes.
+        """
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = sum(len(chunk) for chunk in export())
+        elapsed = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            f"  - {name:8}: {size / 1024:.0f} KiB in {elapsed:.2f}s, peak memory {peak / 1024 / 1024:.1f} MiB"
+        )
+        return peak
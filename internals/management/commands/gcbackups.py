@@ -0,0 +1,120 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from internals.backups import delete_files, get_expired_backups, get_unreferenced, list_blobs
+from internals.models import Backup
+
+import datetime
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes backups outside the retention policy and the files no backup refers to anymore. "
+        "Don't run it at the same time as the backup command, which may reuse a blob being deleted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep-daily",
+            default=30,
+            type=int,
+            help="Number of days all daily backups are kept"
+        )
+        parser.add_argument(
+            "--keep-weekly",
+            default=12,
+            type=int,
+            help="Number of weeks the backups of the last backed up day of every week are kept"
+        )
+        parser.add_argument(
+            "--keep-incremental",
+            default=None,
+            type=int,
+            help="Number of days incremental backups are kept (default: forever)"
+        )
+        parser.add_argument(
+            "--orphans",
+            action="store_true",
+            help="Also list the blobs in the storage and delete the ones no backup refers to"
+        )
+        parser.add_argument(
+            "--grace",
+            default=24,
+            type=int,
+            help="Hours an orphaned blob is kept after it was written, backups record their files at the end of a run"
+        )
+        parser.add_argument(
+            "--jobs",
+            default=8,
+            type=int,
+            help="Number of batches of files deleted concurrently"
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=100,
+            type=int,
+            help="Number of files per batch"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted"
+        )
+        parser.add_argument(
+            "--storage",
+            default=None,
+            help="Dotted path of a storage class to delete from instead of DEFAULT_FILE_STORAGE"
+        )
+
+    def handle(self, *args, **options):
+        storage = import_string(options["storage"])() if options["storage"] else default_storage
+        started = time.monotonic()
+        expired = get_expired_backups(
+            timezone.localdate(), options["keep_daily"], options["keep_weekly"], options["keep_incremental"]
+        )
+
+        with transaction.atomic():
+            names = set()
+            for start in range(0, len(expired), options["batch_size"]):
+                backups = Backup.objects.filter(pk__in=expired[start:start + options["batch_size"]])
+                names.update(backups.values_list('file', flat=True))
+                backups.delete()
+            if options["orphans"]:
+                names.update(self.get_orphans(storage, options["grace"]))
+            # Only files no remaining backup refers to, blobs are shared.
+            unreferenced = get_unreferenced(names)
+            if options["dry_run"]:
+                transaction.set_rollback(True)
+
+        self.stdout.write(f"{len(expired)} backups expired, {len(unreferenced)} files unreferenced")
+        if options["dry_run"]:
+            for name in sorted(unreferenced):
+                self.stdout.write(f"  - {name}")
+            return
+
+        deleted, errors = delete_files(unreferenced, storage, options["jobs"], options["batch_size"])
+        for name, error in errors:
+            self.stderr.write(f"  - {name}: {error}")
+        self.stdout.write(f"Deleted {len(expired)} backups and {deleted} files in {time.monotonic() - started:.1f}s")
+        if errors:
+            raise CommandError(f"{len(errors)} files couldn't be deleted, run the command with --orphans again")
+
+    def get_orphans(self, storage, grace):
+        """
+        Returns the blobs written more than ``grace`` hours ago, the
+        caller filters out the referenced ones.
+        """
+        before = timezone.now() - datetime.timedelta(hours=grace)
+        orphans = []
+        for name in list_blobs(storage):
+            try:
+                if storage.get_modified_time(name) < before:
+                    orphans.append(name)
+            except NotImplementedError:
+                # Age unknown, it may belong to a running backup.
+                continue
+        return orphans
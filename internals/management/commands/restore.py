@@ -0,0 +1,142 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from internals.management.commands.backup import valid_date
+from internals.models import Backup
+from internals.restore import RestoreState, Restorer
+
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads backup files back into the database. Files already restored according to "
+        "the state file are skipped, so an interrupted restore can be started again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--manifest",
+            default=None,
+            help="Name of a backup manifest in the storage to restore the files of, instead of Backup records"
+        )
+        parser.add_argument(
+            "--model",
+            action="append",
+            default=[],
+            help="Only restore this model (app_label.model), can be given several times"
+        )
+        parser.add_argument(
+            "--startdate",
+            default=None,
+            help="Only backups from this date - format YYYY-MM-DD",
+            type=valid_date
+        )
+        parser.add_argument(
+            "--enddate",
+            default=None,
+            help="Only backups before this date - format YYYY-MM-DD (not inclusive)",
+            type=valid_date
+        )
+        parser.add_argument(
+            "--kind",
+            default=None,
+            choices=[Backup.DAILY, Backup.INCREMENTAL],
+            help="Only backups of this kind"
+        )
+        parser.add_argument(
+            "--state",
+            default="restore-state.json",
+            help="File recording the restored backups"
+        )
+        parser.add_argument(
+            "--jobs",
+            default=4,
+            type=int,
+            help="Number of models restored concurrently"
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=5000,
+            type=int,
+            help="Number of rows written at a time"
+        )
+        parser.add_argument(
+            "--storage",
+            default=None,
+            help="Dotted path of a storage class to read from instead of DEFAULT_FILE_STORAGE"
+        )
+
+    def handle(self, *args, **options):
+        storage = import_string(options["storage"])() if options["storage"] else default_storage
+        if options["manifest"]:
+            entries = self.get_manifest_entries(storage, options["manifest"])
+        else:
+            entries = self.get_backup_entries(options)
+
+        files = {}
+        for label, date, key, name in entries:
+            if options["model"] and label not in options["model"]:
+                continue
+            if options["startdate"] and date < options["startdate"].date():
+                continue
+            if options["enddate"] and date >= options["enddate"].date():
+                continue
+            try:
+                model = ContentType.objects.get_by_natural_key(*label.split('.')).model_class()
+            except ContentType.DoesNotExist:
+                model = None
+            if model is None:
+                self.stderr.write(f"Skipping {name}: model {label} doesn't exist")
+                continue
+            files.setdefault(model, []).append((key, name))
+        if not files:
+            raise CommandError("No backups to restore")
+
+        restorer = Restorer(
+            storage=storage,
+            state=RestoreState(options["state"]),
+            batch_size=options["batch_size"],
+            jobs=options["jobs"],
+        )
+        started = time.monotonic()
+        results = restorer.run(files)
+        elapsed = time.monotonic() - started
+
+        for result in results:
+            throughput = result.rows / result.seconds if result.seconds else 0
+            self.stdout.write(
+                f"  - {result.model._meta.label}: {result.files} files, {result.skipped} skipped, "
+                f"{result.rows} rows in {result.seconds:.1f}s ({throughput:.0f} rows/s)"
+            )
+        rows = sum(result.rows for result in results)
+        self.stdout.write(f"Restored {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
+        failed = [result for result in results if result.error]
+        for result in failed:
+            self.stderr.write(f"  - {result.model._meta.label} failed: {result.error}")
+        if failed or len(results) < len(files):
+            raise CommandError("Restore incomplete, run the command again to continue")
+
+    def get_backup_entries(self, options):
+        backups = Backup.objects.select_related('model').order_by('date', 'kind', 'watermark', 'pk')
+        if options["kind"]:
+            backups = backups.filter(kind=options["kind"])
+        return [
+            (f"{backup.model.app_label}.{backup.model.model}", backup.date, f"backup-{backup.pk}", backup.file.name)
+            for backup in backups
+        ]
+
+    def get_manifest_entries(self, storage, name):
+        with storage.open(name, 'rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+        # Entries are keyed by their position, the manifest never changes.
+        return sorted(
+            (
+                (entry['model'], valid_date(entry['date']).date(), f"{name}#{position}", entry['name'])
+                for position, entry in enumerate(manifest['files'])
+            ),
+            key=lambda entry: entry[1],
+        )
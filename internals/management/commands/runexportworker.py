@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from internals.exports import claim_job, run_job
+
+import signal
+import sys
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs the export jobs queued from the admin, one at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            default=5,
+            type=float,
+            help="Seconds to wait before looking for new jobs when the queue is empty"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            default=500,
+            type=int,
+            help="Number of rows fetched at a time, progress is saved after each chunk"
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when the queue is empty"
+        )
+
+    def handle(self, *args, **options):
+        # Heroku stops dynos with SIGTERM, the running job is put back in the queue.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        while True:
+            close_old_connections()
+            job = claim_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+            self.stdout.write(f"Exporting {job.model} ({job.pk})")
+            started = time.monotonic()
+            run_job(job, options["chunk_size"])
+            self.stdout.write(f"  - {job.status}: {job.processed} rows in {time.monotonic() - started:.1f}s")
+            if job.error:
+                self.stderr.write(job.error)
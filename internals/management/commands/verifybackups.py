@@ -0,0 +1,113 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from internals.backups import hash_file, read_rows
+from internals.management.commands.backup import valid_date
+from internals.models import Backup
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+
+class Command(BaseCommand):
+    help = "Checks size and SHA-256 checksum of backup files in the storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--startdate",
+            default=None,
+            help="Only backups from this date - format YYYY-MM-DD",
+            type=valid_date
+        )
+        parser.add_argument(
+            "--enddate",
+            default=None,
+            help="Only backups before this date - format YYYY-MM-DD (not inclusive)",
+            type=valid_date
+        )
+        parser.add_argument(
+            "--jobs",
+            default=8,
+            type=int,
+            help="Number of files checked concurrently"
+        )
+        parser.add_argument(
+            "--rows",
+            action="store_true",
+            help="Also decompress the files and check their row counts"
+        )
+        parser.add_argument(
+            "--storage",
+            default=None,
+            help="Dotted path of a storage class to read from instead of DEFAULT_FILE_STORAGE"
+        )
+
+    def handle(self, *args, **options):
+        storage = import_string(options["storage"])() if options["storage"] else default_storage
+        backups = Backup.objects.select_related('model').order_by('date', 'pk')
+        if options["startdate"]:
+            backups = backups.filter(date__gte=options["startdate"].date())
+        if options["enddate"]:
+            backups = backups.filter(date__lt=options["enddate"].date())
+        backups = list(backups)
+
+        started = time.monotonic()
+        # Backups with the same content share a blob, every file is read once.
+        names = list(dict.fromkeys(backup.file.name for backup in backups if backup.sha256))
+        with ThreadPoolExecutor(options["jobs"]) as executor:
+            files = dict(zip(names, executor.map(lambda name: self.read(storage, name, options["rows"]), names)))
+        statuses = Counter()
+        for backup in backups:
+            status, message = self.verify(backup, files.get(backup.file.name))
+            statuses[status] += 1
+            if status not in ('ok', 'unverifiable'):
+                self.stderr.write(f"  - {backup.file.name}: {message}")
+        self.stdout.write(
+            f"Checked {len(backups)} backups ({len(names)} files) in {time.monotonic() - started:.1f}s: "
+            + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+        )
+        if set(statuses) - {'ok', 'unverifiable'}:
+            raise CommandError("Some backups are missing or corrupt")
+
+    def read(self, storage, name, count_rows):
+        """
+        Returns (size, sha256, rows, error) of a file. rows is None unless
+        count_rows, or the exception raised reading the rows. error is the
+        (status, message) if the file can't be read at all.
+        """
+        try:
+            with storage.open(name, 'rb') as file:
+                size, sha256 = hash_file(file)
+                rows = None
+                if count_rows:
+                    file.seek(0)
+                    try:
+                        rows = sum(1 for row in read_rows(file, name)) - 1
+                    except Exception as e:
+                        rows = e
+        except FileNotFoundError:
+            return None, None, None, ('missing', "file not found")
+        except Exception as e:
+            return None, None, None, ('corrupt', str(e))
+        return size, sha256, rows, None
+
+    def verify(self, backup, file):
+        """
+        Returns (status, message) of a backup given the read() of its file,
+        status is one of ok, unverifiable (backups made before checksums were
+        recorded), missing or corrupt.
+        """
+        if not backup.sha256:
+            return 'unverifiable', "no checksum recorded"
+        size, sha256, rows, error = file
+        if error:
+            return error
+        if size != backup.size or sha256 != backup.sha256:
+            return 'corrupt', f"size {size}, sha256 {sha256}, expected {backup.size}, {backup.sha256}"
+        if isinstance(rows, Exception):
+            return 'corrupt', str(rows)
+        if rows is not None and rows != backup.rows:
+            return 'corrupt', f"{rows} rows, expected {backup.rows}"
+        return 'ok', ""
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.6 on 2026-10-18 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('internals', '0002_school_university'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='rows',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='sha256',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
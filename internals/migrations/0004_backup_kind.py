@@ -0,0 +1,23 @@
+# Generated by Django 3.0.6 on 2026-10-18 12:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('internals', '0003_backup_checksums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='kind',
+            field=models.CharField(choices=[('daily', 'Daily'), ('incremental', 'Incremental')], default='daily', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='watermark',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.0.6 on 2026-10-18 13:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import internals.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('internals', '0004_backup_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.TextField()),
+                ('file_format', models.CharField(max_length=20, verbose_name='Формат')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20, verbose_name='Status')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Total Rows')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Exported Rows')),
+                ('file', models.FileField(blank=True, upload_to=internals.models.get_export_path, verbose_name='Файл')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Создано')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+                ('model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType', verbose_name='Model')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Export Job',
+                'verbose_name_plural': 'Export Jobs',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
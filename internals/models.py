@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils import timezone
@@ -5,20 +6,80 @@ from django.utils.translation import ugettext as _
 
 
 def get_file_path(instance, filename):
-    ext = filename.split('.')[-1]
+    # Keep compound extensions like csv.gz
+    ext = filename.split('.', 1)[-1]
+    if instance.sha256:
+        # Content addressed, backups with equal content share one file.
+        return f"blobs/{instance.sha256[:2]}/{instance.sha256}.{ext}"
     filename = f"{instance.date.year}-{instance.date.month:02d}-{instance.date.day:02d}.{ext}"
+    if instance.kind == Backup.INCREMENTAL:
+        filename = f"incremental/{filename.split('.', 1)[0]}-{instance.watermark}.{ext}"
     return f"{instance.model.app_label}/{instance.model.model}/{filename}"
 
 
 class Backup(models.Model):
+    DAILY = 'daily'
+    INCREMENTAL = 'incremental'
+    KIND_CHOICES = [
+        (DAILY, _('Daily')),
+        (INCREMENTAL, _('Incremental')),
+    ]
+
     model = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     file = models.FileField(upload_to=get_file_path)
     date = models.DateField(default=timezone.now)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=DAILY)
+    # Last history_id contained in an incremental backup
+    watermark = models.BigIntegerField(null=True, blank=True)
+    rows = models.PositiveIntegerField(null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, default='')
 
     def __str__(self):
         return "{} backup ({})".format(self.model, self.date)
 
 
+def get_export_path(instance, filename):
+    return f"exports/{instance.created:%Y-%m-%d}/{instance.pk}/{filename}"
+
+
+class ExportJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    ]
+
+    class Meta:
+        verbose_name = _('Export Job')
+        verbose_name_plural = _('Export Jobs')
+        ordering = ('-created',)
+
+    model = models.ForeignKey(ContentType, on_delete=models.CASCADE, verbose_name=_('Model'))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL, verbose_name=_('User'))
+    # JSON of the changelist filters and of the selected pks, null to export
+    # all rows the filters match
+    query = models.TextField()
+    file_format = models.CharField(max_length=20, verbose_name=_('Format'))
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True,
+                              verbose_name=_('Status'))
+    total = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Total Rows'))
+    processed = models.PositiveIntegerField(default=0, verbose_name=_('Exported Rows'))
+    file = models.FileField(upload_to=get_export_path, blank=True, verbose_name=_('File'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+    created = models.DateTimeField(default=timezone.now, verbose_name=_('Created'))
+    started = models.DateTimeField(null=True, blank=True, verbose_name=_('Started'))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished'))
+
+    def __str__(self):
+        return "{} export ({})".format(self.model, self.created)
+
+
 class Script(models.Model):
     name = models.CharField(_('Name'), max_length=100)
     source = models.TextField(_('Source'))
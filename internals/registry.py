@@ -0,0 +1,89 @@
+"""
+Models that can be backed up, looked up once per process.
+
+Finding them takes a query of all content types, a model_class() call per
+type and the model admins, which the backup admin form and the backup
+command would otherwise repeat on every request and every day. The cache is
+cleared after migrate, which adds and removes content types.
+"""
+from functools import lru_cache
+
+from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
+
+from import_export import resources
+
+EXCLUDED_APPS = ("admin", "auth", "contenttypes", "sessions", "internals")
+
+
+class BackupModel(object):
+    """
+    A model to back up with its content type, the field rows are split into
+    days by and the resource exporting it.
+    """
+    def __init__(self, content_type, model, date_field):
+        self.content_type = content_type
+        self.content_type_id = content_type.pk
+        self.model = model
+        self.date_field = date_field
+        self.resource = get_resource(model)
+
+    @property
+    def label(self):
+        return f"{self.content_type.app_label}.{self.content_type.model}"
+
+
+def get_date_field(content_type, model):
+    """
+    Returns the name of the field rows are split into days by: the
+    date_hierarchy of the model admin or history_date of historical models.
+    """
+    modeladmin = admin.site._registry.get(model)
+    date_hierarchy = getattr(modeladmin, 'date_hierarchy', '')
+    if not date_hierarchy and content_type.model.startswith('historical'):
+        date_hierarchy = "history_date"
+    return date_hierarchy or None
+
+
+@lru_cache(maxsize=None)
+def get_content_types():
+    """
+    Returns the content types whose model exists, by pk.
+    """
+    return {
+        content_type.pk: content_type
+        for content_type in ContentType.objects.order_by('app_label', 'model')
+        if content_type.model_class() is not None
+    }
+
+
+@lru_cache(maxsize=None)
+def get_registry():
+    """
+    Returns the BackupModel of every model with a date field, outside of
+    EXCLUDED_APPS.
+    """
+    registry = []
+    for content_type in get_content_types().values():
+        if content_type.app_label in EXCLUDED_APPS:
+            continue
+        model = content_type.model_class()
+        date_field = get_date_field(content_type, model)
+        if date_field:
+            registry.append(BackupModel(content_type, model, date_field))
+    return tuple(registry)
+
+
+@lru_cache(maxsize=None)
+def get_resource(model):
+    """
+    Returns the import-export resource backups of the model are written and
+    read with. It keeps no state between rows, so threads can share it.
+    """
+    return resources.modelresource_factory(model=model)()
+
+
+def clear_cache(**kwargs):
+    get_content_types.cache_clear()
+    get_registry.cache_clear()
+    get_resource.cache_clear()
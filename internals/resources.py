@@ -0,0 +1,530 @@
+"""
+Import-export resources writing imported rows in bulk.
+
+ModelResource saves every row on its own: the instance is looked up, every
+foreign key and many-to-many value is resolved with a query, save() sends
+the signals which create a historical record, and many-to-many relations are
+set one by one. BulkModelResource loads the existing instances and the
+related objects of the whole dataset up front, collects the rows and writes
+them at the end of the import with bulk_create and bulk_update, creating the
+historical records of models with simple_history in bulk as well. Rows
+aren't wrapped in a savepoint each, the import runs in one transaction. If
+a bulk write fails, e.g. on a duplicate username, its rows are written again
+one by one to report the failing ones as row errors.
+
+Bulk writes don't call save() and send no model signals. New rows get their
+primary keys from the database on PostgreSQL; on other databases, rows
+without an id in the dataset are saved one by one.
+
+Exports would otherwise query the related objects of every foreign key and
+many-to-many field row by row. BulkModelResource joins the foreign keys and
+one-to-ones its export fields follow with select_related and prefetches the
+many-to-many fields for every chunk of rows, so an export runs the same
+queries whatever the number of rows in a chunk.
+"""
+import functools
+import traceback
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import QuerySet, prefetch_related_objects
+from django.utils.encoding import smart_str
+
+import tablib
+from import_export import resources, widgets
+from import_export.instance_loaders import CachedInstanceLoader, ModelInstanceLoader
+from import_export.resources import Diff, get_related_model
+from import_export.results import RowResult
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history, get_history_model_for_model
+
+
+def get_key(model, field, value):
+    """
+    Returns an imported value as the objects loaded by a prefetch are
+    looked up by, e.g. the int of the pk "12". Raises ValidationError if
+    the field can't hold the value.
+    """
+    try:
+        model_field = model._meta.pk if field == 'pk' else model._meta.get_field(field)
+    except FieldDoesNotExist:
+        return value
+    return model_field.to_python(value)
+
+
+def get_keys(model, field, values):
+    """
+    Returns the keys of the values a prefetch looks up. Empty and invalid
+    values are left to the clean() of their rows.
+    """
+    keys = set()
+    for value in values:
+        if value in (None, ''):
+            continue
+        try:
+            keys.add(get_key(model, field, value))
+        except ValidationError:
+            pass
+    return keys
+
+
+def get_lookups(model, attribute):
+    """
+    Returns the select_related and the prefetch_related lookup of the
+    relations an export field attribute such as "student__university"
+    follows, or None for either.
+    """
+    names = attribute.split('__')
+    path = []
+    for name in names:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation:
+            break
+        path.append(name)
+        if field.many_to_many or field.one_to_many:
+            return None, '__'.join(path)
+        model = field.related_model
+    return '__'.join(path) or None, None
+
+
+def with_relations(resource, queryset):
+    """
+    Returns the queryset joining the foreign keys and one-to-ones the export
+    fields of the resource follow and prefetching their many-to-many fields,
+    with the select_related and prefetch_related of its Meta if any.
+    """
+    select_related = list(getattr(resource._meta, 'select_related', ()))
+    prefetch_related = list(getattr(resource._meta, 'prefetch_related', ()))
+    for field in resource.get_export_fields():
+        if not field.attribute:
+            continue
+        select, prefetch = get_lookups(queryset.model, field.attribute)
+        if select and select not in select_related:
+            select_related.append(select)
+        if prefetch and prefetch not in prefetch_related:
+            prefetch_related.append(prefetch)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    return queryset.prefetch_related(*prefetch_related)
+
+
+def iter_chunks(queryset, chunk_size=2000):
+    """
+    Yields lists of up to ``chunk_size`` objects of the queryset, read with
+    iterator(). Django 3.0 ignores prefetch_related() with iterator(), the
+    lookups are prefetched for every chunk instead. The prefetched objects
+    refer back to their instances, they are dropped when the next chunk is
+    read rather than left to the garbage collector.
+    """
+    lookups = queryset._prefetch_related_lookups
+    chunk = []
+    for obj in queryset.prefetch_related(None).iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            prefetch_related_objects(chunk, *lookups)
+            yield chunk
+            for obj in chunk:
+                obj.__dict__.pop('_prefetched_objects_cache', None)
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, *lookups)
+        yield chunk
+        for obj in chunk:
+            obj.__dict__.pop('_prefetched_objects_cache', None)
+
+
+class BulkInstanceLoader(CachedInstanceLoader):
+    """
+    CachedInstanceLoader which also accepts datasets without the import id
+    column, all their rows are new. Instances are loaded with the relations
+    their diffs export.
+    """
+    def __init__(self, resource, dataset=None):
+        field = resource.fields[resource.get_import_id_fields()[0]]
+        if field.column_name in dataset.headers:
+            super(BulkInstanceLoader, self).__init__(resource, dataset)
+        else:
+            ModelInstanceLoader.__init__(self, resource, dataset)
+            self.pk_field = field
+            self.all_instances = {}
+
+    def get_instance(self, row):
+        if self.pk_field.column_name not in row:
+            return None
+        return super(BulkInstanceLoader, self).get_instance(row)
+
+    def get_queryset(self):
+        return with_relations(self.resource, super(BulkInstanceLoader, self).get_queryset())
+
+
+class PrefetchedForeignKeyWidget(widgets.ForeignKeyWidget):
+    """
+    ForeignKeyWidget looking up the objects loaded by prefetch(). Values
+    prefetch() didn't find are looked up by ForeignKeyWidget, which fails
+    their rows.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PrefetchedForeignKeyWidget, self).__init__(*args, **kwargs)
+        self.objects = None
+
+    def prefetch(self, values):
+        keys = get_keys(self.model, self.field, values)
+        self.objects = {
+            getattr(obj, self.field): obj
+            for obj in self.get_queryset(None, None).filter(**{f"{self.field}__in": keys})
+        }
+
+    def clean(self, value, row=None, *args, **kwargs):
+        if self.objects is not None and value not in (None, ''):
+            try:
+                obj = self.objects.get(get_key(self.model, self.field, value))
+            except ValidationError:
+                obj = None
+            if obj is not None:
+                return obj
+        return super(PrefetchedForeignKeyWidget, self).clean(value, row, *args, **kwargs)
+
+
+class PrefetchedManyToManyWidget(widgets.ManyToManyWidget):
+    """
+    ManyToManyWidget returning lists of the objects loaded by prefetch().
+    Values with keys prefetch() didn't find are looked up by
+    ManyToManyWidget, which leaves unknown keys out and fails the rows of
+    invalid ones.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PrefetchedManyToManyWidget, self).__init__(*args, **kwargs)
+        self.objects = None
+
+    def split(self, value):
+        if not value:
+            return []
+        if isinstance(value, (float, int)):
+            return [int(value)]
+        return [key.strip() for key in value.split(self.separator) if key.strip()]
+
+    def prefetch(self, values):
+        keys = get_keys(self.model, self.field, [key for value in values for key in self.split(value)])
+        self.objects = {
+            getattr(obj, self.field): obj for obj in self.model.objects.filter(**{f"{self.field}__in": keys})
+        }
+
+    def clean(self, value, row=None, *args, **kwargs):
+        if self.objects is not None:
+            try:
+                keys = [get_key(self.model, self.field, key) for key in self.split(value)]
+            except ValidationError:
+                keys = None
+            if keys is not None and all(key in self.objects for key in keys):
+                return [self.objects[key] for key in keys]
+        # The relations are written after the import, evaluate the lookup
+        # now for its errors to fail this row only.
+        return list(super(PrefetchedManyToManyWidget, self).clean(value, row, *args, **kwargs))
+
+
+class BulkDiff(Diff):
+    """
+    Diff exporting the original of an updated row from the instance the
+    BulkInstanceLoader loaded. import_row() passes a deep copy, which drops
+    the prefetched relations.
+    """
+    def __init__(self, resource, instance, new):
+        if not new:
+            instance = resource.get_loaded_instance(instance)
+        super(BulkDiff, self).__init__(resource, instance, new)
+
+
+class BulkModelResource(resources.ModelResource):
+    """
+    ModelResource writing the imported rows in bulk and exporting them
+    with their relations, see the module docstring. ``batch_size`` in Meta
+    sets the rows per query, ``select_related`` and ``prefetch_related``
+    add lookups to the ones of the export fields. Imports without a preview
+    may set ``skip_diff`` in Meta, diffs are most of the time of an import.
+    """
+    class Meta:
+        instance_loader_class = BulkInstanceLoader
+        batch_size = 1000
+        select_related = ()
+        prefetch_related = ()
+
+    def __init__(self, *args, **kwargs):
+        super(BulkModelResource, self).__init__(*args, **kwargs)
+        self._user = None
+        self._using_transactions = False
+        self._raise_errors = False
+        self._collect_failed_rows = False
+        self._headers = ()
+        self._instance_loader = None
+        self._create = []
+        self._update = []
+        self._m2m = {}
+        self._row_results = {}
+
+    @classmethod
+    def get_fk_widget(cls, field):
+        return functools.partial(PrefetchedForeignKeyWidget, model=get_related_model(field))
+
+    @classmethod
+    def get_m2m_widget(cls, field):
+        return functools.partial(PrefetchedManyToManyWidget, model=get_related_model(field))
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        super(BulkModelResource, self).before_import(dataset, using_transactions, dry_run, **kwargs)
+        self._user = kwargs.get('user')
+        self._headers = dataset.headers
+        for field in self.get_import_fields():
+            if hasattr(field.widget, 'prefetch') and field.column_name in dataset.headers:
+                field.widget.prefetch(dataset[field.column_name])
+
+    def import_data_inner(self, dataset, dry_run, raise_errors, using_transactions, collect_failed_rows, **kwargs):
+        # Rows are written at the end, a savepoint per row would only cost two
+        # queries per row. import_data() runs this in a transaction already,
+        # which is rolled back instead.
+        self._using_transactions = using_transactions
+        self._raise_errors = raise_errors
+        self._collect_failed_rows = collect_failed_rows
+        result = super(BulkModelResource, self).import_data_inner(
+            dataset, dry_run, raise_errors, False, collect_failed_rows, **kwargs
+        )
+        if using_transactions and (dry_run or result.has_errors()):
+            transaction.set_rollback(True)
+        return result
+
+    def get_diff_class(self):
+        return BulkDiff
+
+    def get_loaded_instance(self, instance):
+        """
+        Returns the instance with the primary key of ``instance`` that the
+        instance loader loaded, or ``instance``.
+        """
+        return getattr(self._instance_loader, 'all_instances', {}).get(instance.pk, instance)
+
+    def import_row(self, row, instance_loader, using_transactions=True, dry_run=False, **kwargs):
+        self._instance_loader = instance_loader
+        created, updated = len(self._create), len(self._update)
+        row_result = super(BulkModelResource, self).import_row(
+            row, instance_loader, using_transactions, dry_run, **kwargs
+        )
+        if len(self._create) > created:
+            instance = self._create[-1]
+        elif len(self._update) > updated:
+            instance = self._update[-1]
+        else:
+            return row_result
+        if row_result.import_type in (RowResult.IMPORT_TYPE_ERROR, RowResult.IMPORT_TYPE_INVALID):
+            # The row failed after save_instance(), e.g. on a many-to-many
+            # value, don't write it.
+            del self._create[created:], self._update[updated:]
+            self._m2m = {key: value for key, value in self._m2m.items() if key[0] != id(instance)}
+            return row_result
+        # The primary key and write errors are only known after the rows are
+        # written.
+        self._row_results[id(instance)] = (row_result, row, instance)
+        return row_result
+
+    def save_instance(self, instance, using_transactions=True, dry_run=False):
+        using_transactions = self._using_transactions
+        self.before_save_instance(instance, using_transactions, dry_run)
+        if not using_transactions and dry_run:
+            # we don't have transactions and we want to do a dry_run
+            pass
+        elif instance._state.adding:
+            self._create.append(instance)
+        else:
+            self._update.append(instance)
+        self.after_save_instance(instance, using_transactions, dry_run)
+
+    def save_m2m(self, obj, data, using_transactions, dry_run):
+        if not self._using_transactions and dry_run:
+            return
+        for field in self.get_import_fields():
+            if isinstance(field.widget, widgets.ManyToManyWidget) and field.column_name in data and not field.readonly:
+                self._m2m[id(obj), field.attribute] = (obj, field.clean(data))
+
+    def export_field(self, field, obj):
+        pending = self._m2m.get((id(obj), field.attribute))
+        if pending is not None:
+            # Diffs of imported rows show the relations still to be written.
+            widget = field.widget
+            return widget.separator.join(smart_str(getattr(related, widget.field)) for related in pending[1])
+        if obj._state.adding and field.attribute:
+            try:
+                model_field = obj._meta.get_field(field.attribute.split('__')[0])
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is not None and (model_field.many_to_many or not model_field.concrete):
+                # New rows have no related rows yet, don't look them up.
+                return ''
+        return super(BulkModelResource, self).export_field(field, obj)
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        failed = self.write_rows()
+        for row_result, row, instance in self._row_results.values():
+            row_result.object_id = instance.pk
+        for instance, error in failed:
+            row_result, row, instance = self._row_results[id(instance)]
+            result.totals[row_result.import_type] -= 1
+            row_result.import_type = RowResult.IMPORT_TYPE_ERROR
+            row_result.errors.append(error)
+            error.row = row
+            result.increment_row_result_total(row_result)
+            if self._collect_failed_rows:
+                result.append_failed_row(row, error)
+        self._row_results = {}
+        if failed and self._raise_errors:
+            raise failed[0][1].error
+        super(BulkModelResource, self).after_import(dataset, result, using_transactions, dry_run, **kwargs)
+
+    def export(self, queryset=None, *args, **kwargs):
+        self.before_export(queryset, *args, **kwargs)
+        if queryset is None:
+            queryset = self.get_queryset()
+        data = tablib.Dataset(headers=self.get_export_headers())
+        if isinstance(queryset, QuerySet):
+            for chunk in iter_chunks(with_relations(self, queryset), self._meta.batch_size):
+                for obj in chunk:
+                    data.append(self.export_resource(obj))
+        else:
+            for obj in queryset:
+                data.append(self.export_resource(obj))
+        self.after_export(queryset, data, *args, **kwargs)
+        return data
+
+    def get_update_fields(self):
+        """
+        Returns the names of the model fields set from the dataset.
+        """
+        model = self._meta.model
+        names = []
+        for field in self.get_import_fields():
+            if field.readonly or not field.attribute or '__' in field.attribute:
+                continue
+            if field.column_name not in self._headers or isinstance(field.widget, widgets.ManyToManyWidget):
+                continue
+            model_field = model._meta.get_field(field.attribute)
+            if model_field.concrete and not model_field.primary_key and not model_field.many_to_many:
+                names.append(model_field.name)
+        return names
+
+    def get_batch_size(self, connection, *models):
+        """
+        Returns the Meta batch_size, lowered to the rows of the models the
+        database accepts in one INSERT. Django 3.0 doesn't lower a given
+        batch_size itself, which fails on SQLite.
+        """
+        batch_size = self._meta.batch_size
+        for model in models:
+            limit = connection.ops.bulk_batch_size(model._meta.concrete_fields, [None] * batch_size)
+            batch_size = max(min(batch_size, limit), 1)
+        return batch_size
+
+    def write_rows(self):
+        """
+        Writes the collected rows and returns the (instance, Error) of the
+        ones the database refused.
+        """
+        model = self._meta.model
+        connection = connections[router.db_for_write(model)]
+        historical = hasattr(model._meta, 'simple_history_manager_attribute')
+        if historical:
+            batch_size = self.get_batch_size(connection, model, get_history_model_for_model(model))
+        else:
+            batch_size = self.get_batch_size(connection, model)
+
+        failed = []
+        create = self._create
+        if not connection.features.can_return_rows_from_bulk_insert:
+            failed += self.write(connection, [obj for obj in create if obj.pk is None], lambda objs: [
+                obj.save() for obj in objs
+            ])
+            create = [obj for obj in create if obj.pk is not None and obj._state.adding]
+        if create and historical:
+            failed += self.write(connection, create, lambda objs: bulk_create_with_history(
+                objs, model, batch_size=batch_size, default_user=self._user
+            ))
+        elif create:
+            failed += self.write(connection, create, lambda objs: model.objects.bulk_create(
+                objs, batch_size=batch_size
+            ))
+        refused = {id(obj) for obj, error in failed}
+        for obj in create:
+            if id(obj) not in refused:
+                obj._state.adding = False
+
+        fields = self.get_update_fields()
+        if self._update and fields and historical:
+            failed += self.write(connection, self._update, lambda objs: bulk_update_with_history(
+                objs, model, fields, batch_size=batch_size, default_user=self._user
+            ))
+        elif self._update and fields:
+            failed += self.write(connection, self._update, lambda objs: model.objects.bulk_update(
+                objs, fields, batch_size=batch_size
+            ))
+
+        refused = {id(obj) for obj, error in failed}
+        self._m2m = {key: value for key, value in self._m2m.items() if key[0] not in refused}
+        self.write_m2m()
+        self._create, self._update, self._m2m = [], [], {}
+        return failed
+
+    def write(self, connection, objs, write):
+        """
+        Calls ``write`` with all objects in a savepoint. If the database
+        refuses them, calls it again for every object in a savepoint of its
+        own and returns the (object, Error) of the ones that fail.
+        """
+        state = [(obj, obj.pk, obj._state.adding) for obj in objs]
+        try:
+            with transaction.atomic(using=connection.alias):
+                write(objs)
+            return []
+        except DatabaseError:
+            pass
+        failed = []
+        for obj, pk, adding in state:
+            # Undo what the rolled back write set.
+            obj.pk, obj._state.adding = pk, adding
+            try:
+                with transaction.atomic(using=connection.alias):
+                    write([obj])
+            except DatabaseError as e:
+                obj.pk, obj._state.adding = pk, adding
+                failed.append((obj, self.get_error_result_class()(e, traceback.format_exc())))
+        return failed
+
+    def write_m2m(self):
+        """
+        Replaces the many-to-many relations of the imported rows, with one
+        delete and one insert per relation.
+        """
+        relations = {}
+        for (key, name), (obj, objects) in self._m2m.items():
+            relations.setdefault(name, []).append((obj.pk, [related.pk for related in objects]))
+        for name, rows in relations.items():
+            field = self._meta.model._meta.get_field(name)
+            through = field.remote_field.through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+            batch_size = self.get_batch_size(connections[router.db_for_write(through)], through)
+            for start in range(0, len(rows), batch_size):
+                through.objects.filter(**{f"{source}__in": [pk for pk, pks in rows[start:start + batch_size]]}).delete()
+            through.objects.bulk_create(
+                [through(**{f"{source}_id": pk, f"{target}_id": related}) for pk, pks in rows for related in pks],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+
+
+class BulkImportMixin(object):
+    """
+    ImportExportMixin admin mixin importing with a BulkModelResource of the
+    model when no resource_class is set.
+    """
+    def get_resource_class(self):
+        if not self.resource_class:
+            return resources.modelresource_factory(self.model, BulkModelResource)
+        return self.resource_class
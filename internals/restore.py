@@ -0,0 +1,315 @@
+"""
+Loading of backup files back into the database.
+
+Files are streamed from the storage and written in batches: on PostgreSQL
+each file is copied with COPY into a temporary staging table and merged with
+one INSERT ... ON CONFLICT, elsewhere rows are split into bulk_create and
+bulk_update batches. Bulk writes don't send model signals, so restoring
+creates no historical records. Files of one model are restored in order,
+models which don't depend on each other in parallel.
+
+Every file is restored in its own transaction and recorded in a state file
+when committed, an interrupted restore continues with the next file. Files
+are recorded by a key of the backup they belong to rather than by name:
+backups with the same content share one file, which has to be restored
+again for every one of them.
+"""
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.storage import default_storage
+from django.core.management.color import no_style
+from django.db import connections, models, router, transaction
+
+from .backups import read_rows
+from .registry import get_resource
+from .utils import chunked
+
+
+class RowConverter(object):
+    """
+    Turns rows of a backup file into model field values, using the widgets
+    of the resource the file was exported with.
+    """
+    def __init__(self, model, headers):
+        self.model = model
+        columns = {field.column_name: field for field in get_resource(model).get_export_fields()}
+        self.fields = []
+        self.m2m = []
+        for position, header in enumerate(headers):
+            field = columns.get(header)
+            try:
+                model_field = model._meta.get_field(field.attribute if field else header)
+            except FieldDoesNotExist:
+                continue
+            if model_field.many_to_many:
+                self.m2m.append((position, model_field))
+            elif model_field.concrete:
+                self.fields.append((position, model_field, field.widget if field else None))
+
+    def clean(self, value, model_field, widget):
+        if value is None or value == '':
+            # CSV has no NULL, an empty value of a nullable field is read as one.
+            if model_field.null or value is None:
+                return None
+            if isinstance(model_field, (models.CharField, models.TextField)):
+                return ''
+        if model_field.is_relation:
+            return model_field.target_field.to_python(value)
+        if widget is not None:
+            return widget.clean(value)
+        return model_field.to_python(value)
+
+    def convert(self, row):
+        """
+        Returns the {attname: value} of the concrete fields and
+        {field: [related pks]} of the many-to-many fields of a row.
+        """
+        values = {
+            model_field.attname: self.clean(row[position], model_field, widget)
+            for position, model_field, widget in self.fields
+        }
+        m2m = {
+            model_field: [model_field.target_field.to_python(pk) for pk in (row[position] or '').split(',') if pk]
+            for position, model_field in self.m2m
+        }
+        return values, m2m
+
+
+# Internal types of the fields whose database values copy_value() formats.
+# Fields of other types, e.g. binary or JSON values passed as adapters, are
+# restored with bulk_create and bulk_update.
+COPY_TYPES = frozenset([
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'BigIntegerField', 'IntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'BooleanField', 'NullBooleanField', 'CharField',
+    'TextField', 'SlugField', 'EmailField', 'URLField', 'FileField', 'FilePathField', 'DateField',
+    'DateTimeField', 'TimeField', 'DecimalField', 'FloatField', 'UUIDField', 'GenericIPAddressField',
+    'IPAddressField',
+])
+
+
+def can_copy(field):
+    """
+    Returns True if copy_value() formats the database values of the field.
+    """
+    if field.is_relation:
+        field = field.target_field
+    return field.get_internal_type() in COPY_TYPES
+
+
+def copy_value(value):
+    """
+    Formats a database value for COPY in text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def get_dependencies(model):
+    """
+    Returns the models the table of the model has foreign key constraints to.
+    """
+    dependencies = set()
+    for field in model._meta.get_fields():
+        if field.many_to_many and field.concrete:
+            dependencies.add(field.related_model)
+        elif (field.many_to_one or field.one_to_one) and field.concrete and field.db_constraint:
+            dependencies.add(field.related_model)
+    dependencies.discard(model)
+    return dependencies
+
+
+def get_levels(models):
+    """
+    Splits models into levels, every model only depends on models of
+    earlier levels. Models of a dependency cycle end up in the same level.
+    """
+    remaining = set(models)
+    levels = []
+    while remaining:
+        level = {model for model in remaining if not get_dependencies(model) & remaining} or remaining
+        levels.append(sorted(level, key=lambda model: model._meta.label))
+        remaining -= level
+    return levels
+
+
+class RestoreState(object):
+    """
+    Keys of the backups restored so far, kept in a JSON file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key, rows):
+        with self._lock:
+            self.done[key] = rows
+            if self.path:
+                with open(f"{self.path}.tmp", 'w') as f:
+                    json.dump(self.done, f)
+                os.replace(f"{self.path}.tmp", self.path)
+
+
+class RestoreResult(object):
+    def __init__(self, model, files=0, skipped=0, rows=0, seconds=0.0, error=None):
+        self.model = model
+        self.files = files
+        self.skipped = skipped
+        self.rows = rows
+        self.seconds = seconds
+        self.error = error
+
+
+class Restorer(object):
+    """
+    Restores lists of backup files per model, see the module docstring.
+    """
+    def __init__(self, storage=None, state=None, batch_size=5000, jobs=1):
+        self.storage = storage or default_storage
+        self.state = state or RestoreState(None)
+        self.batch_size = batch_size
+        self.jobs = jobs
+
+    def run(self, files):
+        """
+        Takes {model: [(backup key, file name)]} and returns a RestoreResult
+        per model.
+        """
+        results = []
+        with ThreadPoolExecutor(self.jobs, thread_name_prefix='restore') as executor:
+            for level in get_levels(files):
+                results.extend(executor.map(lambda model: self.restore_model(model, files[model]), level))
+                if any(result.error for result in results):
+                    # Models of later levels may reference the missing rows.
+                    break
+        self.reset_sequences(list(files))
+        return results
+
+    def restore_model(self, model, files):
+        result = RestoreResult(model)
+        started = time.monotonic()
+        try:
+            for key, name in files:
+                if key in self.state:
+                    result.skipped += 1
+                    continue
+                rows = self.restore_file(model, name)
+                self.state.add(key, rows)
+                result.files += 1
+                result.rows += rows
+        except Exception as e:
+            result.error = f"{name}: {e}"
+        finally:
+            connections[router.db_for_write(model)].close()
+        result.seconds = time.monotonic() - started
+        return result
+
+    def restore_file(self, model, name):
+        using = router.db_for_write(model)
+        connection = connections[using]
+        with self.storage.open(name, 'rb') as file:
+            rows = read_rows(file, name)
+            converter = RowConverter(model, next(rows))
+            copy = connection.vendor == 'postgresql' and all(
+                can_copy(model_field) for position, model_field, widget in converter.fields
+            )
+            with transaction.atomic(using=using):
+                if copy:
+                    return self.copy_rows(connection, converter, rows)
+                return self.bulk_rows(using, converter, rows)
+
+    def bulk_rows(self, using, converter, rows):
+        model = converter.model
+        manager = model._default_manager.db_manager(using)
+        pk = model._meta.pk
+        update_fields = [model_field.name for position, model_field, widget in converter.fields if not model_field.primary_key]
+        count = 0
+        for batch in chunked(rows, self.batch_size):
+            converted = [converter.convert(row) for row in batch]
+            objs = [model(**values) for values, m2m in converted]
+            existing = set(manager.filter(pk__in=[obj.pk for obj in objs]).values_list('pk', flat=True))
+            manager.bulk_create([obj for obj in objs if obj.pk not in existing], batch_size=self.batch_size)
+            if update_fields:
+                manager.bulk_update(
+                    [obj for obj in objs if obj.pk in existing], update_fields, batch_size=self.batch_size
+                )
+            self.add_m2m(using, [(values[pk.attname], m2m) for values, m2m in converted])
+            count += len(batch)
+        return count
+
+    def copy_rows(self, connection, converter, rows):
+        model = converter.model
+        qn = connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        staging = qn(f"restore_{model._meta.db_table}")
+        fields = [model_field for position, model_field, widget in converter.fields]
+        columns = ', '.join(qn(field.column) for field in fields)
+        updates = ', '.join(
+            f"{qn(field.column)} = EXCLUDED.{qn(field.column)}" for field in fields if not field.primary_key
+        )
+        count = 0
+        with connection.cursor() as cursor, tempfile.TemporaryFile('w+', encoding='utf-8') as buffer:
+            cursor.execute(f"CREATE TEMPORARY TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+            for batch in chunked(rows, self.batch_size):
+                converted = [converter.convert(row) for row in batch]
+                for values, m2m in converted:
+                    buffer.write('\t'.join(
+                        copy_value(field.get_db_prep_save(values[field.attname], connection)) for field in fields
+                    ))
+                    buffer.write('\n')
+                self.add_m2m(connection.alias, [(values[model._meta.pk.attname], m2m) for values, m2m in converted])
+                count += len(batch)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN", buffer)
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+                f"ON CONFLICT ({qn(model._meta.pk.column)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING")
+            )
+        return count
+
+    def add_m2m(self, using, rows):
+        """
+        Adds the many-to-many relations of restored rows, existing ones are
+        kept.
+        """
+        links = {}
+        for pk, m2m in rows:
+            for field, related in m2m.items():
+                through = field.remote_field.through
+                source = f"{field.m2m_field_name()}_id"
+                target = f"{field.m2m_reverse_field_name()}_id"
+                links.setdefault(through, []).extend(through(**{source: pk, target: value}) for value in related)
+        for through, objs in links.items():
+            through._default_manager.db_manager(using).bulk_create(
+                objs, batch_size=self.batch_size, ignore_conflicts=True
+            )
+
+    def reset_sequences(self, models):
+        """
+        Moves the primary key sequences past the restored ids.
+        """
+        for model in models:
+            connection = connections[router.db_for_write(model)]
+            statements = connection.ops.sequence_reset_sql(no_style(), [model])
+            if statements:
+                with connection.cursor() as cursor:
+                    for sql in statements:
+                        cursor.execute(sql)
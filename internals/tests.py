@@ -1,3 +1,296 @@
-from django.test import TestCase
+from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management import CommandError, call_command
+from django.db import models
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
 
-# Create your tests here.
+from trainings.models import Topic
+from users.models import Parent, User
+
+from .backups import hash_file
+from .exports import run_job, stream_csv, stream_jsonl
+from .models import Backup, ExportJob, School
+from .resources import BulkModelResource
+from .restore import can_copy
+
+import io
+import json
+import os
+import tablib
+import tempfile
+import tracemalloc
+
+
+def get_format(model, title):
+    formats = [file_format().get_title() for file_format in admin.site._registry[model].get_export_formats()]
+    return formats.index(title)
+
+
+class ExportJobAdminTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('staff', password='secret', is_staff=True, phone_number='+375291234567')
+        self.user.user_permissions.add(Permission.objects.get(codename='change_user'))
+        self.client.force_login(self.user)
+
+    def test_staff_follow_their_export(self):
+        response = self.client.post(reverse('admin:users_user_export'), {'file_format': get_format(User, 'xlsx')})
+        job = ExportJob.objects.get()
+        self.assertRedirects(response, reverse('admin:internals_exportjob_change', args=[job.pk]))
+        self.assertEqual(job.user, self.user)
+        self.assertEqual(self.client.get(reverse('admin:internals_exportjob_change', args=[job.pk])).status_code, 200)
+        response = self.client.get(reverse('admin:internals_exportjob_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+    def test_staff_dont_see_other_jobs(self):
+        other = User.objects.create_user('other', phone_number='+375291234568')
+        job = ExportJob.objects.create(
+            model=ContentType.objects.get_for_model(User), user=other, file_format='xlsx',
+            query=json.dumps({'filters': {}, 'pks': None}),
+        )
+        response = self.client.get(reverse('admin:internals_exportjob_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 0)
+        response = self.client.get(reverse('admin:internals_exportjob_change', args=[job.pk]))
+        self.assertRedirects(response, reverse('admin:index'))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ExportJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', password='secret', phone_number='+375291234567')
+        self.client.force_login(self.user)
+
+    def test_job_exports_the_filtered_rows(self):
+        for i in range(3):
+            User.objects.create_user(f"senior{i}", phone_number='+375291234567', group='senior')
+        url = reverse('admin:users_user_export') + '?group__exact=senior'
+        self.client.post(url, {'file_format': get_format(User, 'xlsx')})
+        job = run_job(ExportJob.objects.get())
+        self.assertEqual(job.status, ExportJob.DONE, job.error)
+        self.assertEqual(job.total, 3)
+        self.assertEqual(json.loads(job.query), {'filters': {'group__exact': ['senior']}, 'pks': None})
+
+    def test_job_exports_the_selected_rows(self):
+        topics = [Topic.objects.create(title=f"Topic {i}", order=i) for i in range(5)]
+        self.client.post(reverse('admin:trainings_topic_changelist'), {
+            'action': 'export_admin_action',
+            'file_format': get_format(Topic, 'xlsx'),
+            helpers.ACTION_CHECKBOX_NAME: [topics[1].pk, topics[3].pk],
+            'index': 0,
+        })
+        job = run_job(ExportJob.objects.get())
+        self.assertEqual(job.status, ExportJob.DONE, job.error)
+        self.assertEqual(job.total, 2)
+
+
+class StreamingExportTests(SimpleTestCase):
+    headers = ['id', 'username', 'first_name', 'last_name', 'date_joined']
+
+    def get_rows(self, count):
+        now = timezone.now()
+        for i in range(count):
+            yield [i, f"user{i}", "Ivan", "Ivanov" * 5, now]
+
+    def get_peak(self, stream, count):
+        """
+        Returns the peak memory allocated while the output of ``count`` rows
+        is consumed like a StreamingHttpResponse does.
+        """
+        tracemalloc.start()
+        try:
+            size = sum(len(chunk) for chunk in stream(self.headers, self.get_rows(count), 100))
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertGreater(size, count * 20)
+        return peak
+
+    def assertBounded(self, stream):
+        peak = self.get_peak(stream, 2000)
+        # The output of 10 times the rows is about 10 times larger, memory
+        # mustn't grow with it.
+        self.assertLess(self.get_peak(stream, 20000), peak * 1.5)
+
+    def test_csv_memory_is_bounded(self):
+        self.assertBounded(stream_csv)
+
+    def test_jsonl_memory_is_bounded(self):
+        self.assertBounded(stream_jsonl)
+
+
+class UserImportResource(BulkModelResource):
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'phone_number', 'school', 'parents')
+
+
+class BulkImportTests(TestCase):
+    headers = ['id', 'username', 'phone_number', 'school', 'parents']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.school = School.objects.create(full_name="School 1")
+        cls.parents = [
+            Parent.objects.create(
+                sex='female', last_name="Ivanova", first_name=f"Anna {i}", job="Teacher", phone_number="+375291234567"
+            )
+            for i in range(2)
+        ]
+        cls.user = User.objects.create_user("user", phone_number="+375291234567")
+
+    def import_rows(self, *rows, dry_run=False):
+        dataset = tablib.Dataset(*rows, headers=self.headers)
+        return UserImportResource().import_data(dataset, dry_run=dry_run)
+
+    def assertRowErrors(self, result, rows):
+        self.assertEqual(result.base_errors, [])
+        self.assertEqual([number for number, errors in result.row_errors()], rows)
+
+    def test_create_and_update(self):
+        parents = ','.join(str(parent.pk) for parent in self.parents)
+        result = self.import_rows(
+            [self.user.pk, 'renamed', '+375291234567', self.school.pk, parents],
+            ['', 'new', '+375291234568', self.school.pk, self.parents[0].pk],
+        )
+        self.assertFalse(result.has_errors())
+        self.assertEqual((result.totals['new'], result.totals['update']), (1, 1))
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.username, 'renamed')
+        self.assertEqual(self.user.school, self.school)
+        self.assertEqual(set(self.user.parents.all()), set(self.parents))
+        new = User.objects.get(username='new')
+        self.assertEqual(new.school, self.school)
+        self.assertEqual(list(new.parents.all()), self.parents[:1])
+        self.assertEqual(result.rows[1].object_id, new.pk)
+        self.assertEqual(User.history.filter(id__in=[self.user.pk, new.pk], history_type='+').count(), 2)
+        self.assertEqual(User.history.filter(id=self.user.pk, history_type='~').count(), 1)
+
+    def test_duplicate_rows_are_row_errors(self):
+        result = self.import_rows(
+            ['', 'new', '+375291234567', '', ''],
+            ['', 'new', '+375291234567', '', ''],
+            ['', 'user', '+375291234567', '', ''],
+        )
+        self.assertRowErrors(result, [2, 3])
+        self.assertEqual(result.totals['new'], 1)
+        # Rows with errors roll the import back.
+        self.assertFalse(User.objects.filter(username='new').exists())
+
+    def test_unknown_foreign_keys_are_row_errors(self):
+        result = self.import_rows(
+            ['', 'new1', '+375291234567', self.school.pk, ''],
+            ['', 'new2', '+375291234567', 12345, ''],
+            ['', 'new3', '+375291234567', 'school', ''],
+        )
+        self.assertRowErrors(result, [2])
+        # As with ModelResource, a value the primary key can't hold is a
+        # validation error of its row.
+        self.assertEqual([row.import_type for row in result.rows], ['new', 'error', 'invalid'])
+
+    def test_unknown_many_to_many_keys(self):
+        result = self.import_rows(
+            ['', 'new1', '+375291234567', '', f'{self.parents[0].pk},12345'],
+            ['', 'new2', '+375291234567', '', 'parent'],
+        )
+        # Unknown keys are left out like ModelResource does, invalid ones
+        # fail their row only.
+        self.assertRowErrors(result, [2])
+        self.assertEqual(result.rows[0].import_type, 'new')
+
+        result = self.import_rows(['', 'new1', '+375291234567', '', f'{self.parents[0].pk},12345'])
+        self.assertFalse(result.has_errors())
+        self.assertEqual(list(User.objects.get(username='new1').parents.all()), self.parents[:1])
+
+    def test_dry_run_rolls_back(self):
+        history = User.history.count()
+        result = self.import_rows(
+            [self.user.pk, 'renamed', '+375291234567', self.school.pk, self.parents[0].pk],
+            ['', 'new', '+375291234567', '', self.parents[1].pk],
+            dry_run=True,
+        )
+        self.assertFalse(result.has_errors())
+        self.assertEqual((result.totals['new'], result.totals['update']), (1, 1))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.username, 'user')
+        self.assertFalse(self.user.parents.exists())
+        self.assertFalse(User.objects.filter(username='new').exists())
+        self.assertEqual(User.history.count(), history)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class RestoreTests(TransactionTestCase):
+    def save(self, name, content):
+        default_storage.save(name, ContentFile(content.encode('utf-8')))
+
+    def restore(self, manifest, state):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('restore', manifest=manifest, state=state, jobs=1, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_restore_manifest(self):
+        self.save('blobs/a.csv', 'id,full_name,headmaster\r\n1,School A,\r\n')
+        self.save('blobs/b.csv', 'id,full_name,headmaster\r\n1,School B,\r\n')
+        self.save('manifests/1.json', json.dumps({'files': [
+            {'model': 'internals.school', 'date': '2020-05-01', 'name': 'blobs/a.csv'},
+            {'model': 'internals.school', 'date': '2020-05-02', 'name': 'blobs/b.csv'},
+            # Same content as the first day, stored once.
+            {'model': 'internals.school', 'date': '2020-05-03', 'name': 'blobs/a.csv'},
+            {'model': 'removed.model', 'date': '2020-05-01', 'name': 'blobs/c.csv'},
+        ]}))
+        state = os.path.join(tempfile.mkdtemp(), 'state.json')
+
+        stdout, stderr = self.restore('manifests/1.json', state)
+        self.assertIn("internals.School: 3 files, 0 skipped", stdout)
+        self.assertIn("Skipping blobs/c.csv: model removed.model doesn't exist", stderr)
+        self.assertEqual(School.objects.get(pk=1).full_name, "School A")
+
+        stdout, stderr = self.restore('manifests/1.json', state)
+        self.assertIn("internals.School: 0 files, 3 skipped", stdout)
+
+    def test_can_copy(self):
+        self.assertTrue(can_copy(School._meta.get_field('full_name')))
+        self.assertTrue(can_copy(User._meta.get_field('school')))
+        self.assertFalse(can_copy(models.BinaryField()))
+
+
+class CountingStorage(FileSystemStorage):
+    opened = []
+
+    def _open(self, name, mode='rb'):
+        self.opened.append(name)
+        return super(CountingStorage, self)._open(name, mode)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class VerifyBackupsTests(TestCase):
+    def create_backup(self, name, content, **kwargs):
+        size, sha256 = hash_file(io.BytesIO(content))
+        fields = dict(model=ContentType.objects.get_for_model(School), file=name, rows=1, size=size, sha256=sha256)
+        fields.update(kwargs)
+        return Backup.objects.create(**fields)
+
+    def test_verify(self):
+        content = b'id,full_name,headmaster\r\n1,School A,\r\n'
+        CountingStorage().save('blobs/a.csv', ContentFile(content))
+        for i in range(3):
+            self.create_backup('blobs/a.csv', content)
+        self.create_backup('blobs/a.csv', content, rows=2)
+        self.create_backup('blobs/b.csv', content)
+        self.create_backup('blobs/c.csv', content, sha256='')
+
+        CountingStorage.opened = []
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command(
+                'verifybackups', rows=True, storage='internals.tests.CountingStorage', stdout=stdout, stderr=stderr
+            )
+        self.assertEqual(sorted(CountingStorage.opened), ['blobs/a.csv', 'blobs/b.csv'])
+        self.assertIn("Checked 6 backups (2 files)", stdout.getvalue())
+        self.assertIn("1 corrupt, 1 missing, 3 ok, 1 unverifiable", stdout.getvalue())
+        self.assertIn("blobs/a.csv: 1 rows, expected 2", stderr.getvalue())
@@ -0,0 +1,13 @@
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to ``size`` items of the iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -6,11 +6,14 @@ from django.utils.html import format_html
 from import_export.admin import ImportExportActionModelAdmin
 from simple_history.admin import SimpleHistoryAdmin
 
+from internals.exports import BackgroundExportMixin
+from internals.resources import BulkImportMixin
+
 from .models import Topic, Task, StandardTest
 
 
 @admin.register(Topic)
-class TopicAdmin(SortableAdminMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
+class TopicAdmin(SortableAdminMixin, BulkImportMixin, BackgroundExportMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
     list_display = ('title_with_number', 'order')
     search_fields = ('title', 'order')
 
@@ -26,7 +29,7 @@ class StandardTestInline(admin.TabularInline):
 
 
 @admin.register(Task)
-class TaskAdmin(SortableAdminMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
+class TaskAdmin(SortableAdminMixin, BulkImportMixin, BackgroundExportMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
     list_display = ('title', 'topic_num',)
     list_filter = ('topic',)
     search_fields = ('title', 'description')
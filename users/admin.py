@@ -7,8 +7,11 @@ from django.utils.translation import ugettext as _
 from simple_history.admin import SimpleHistoryAdmin
 from import_export.admin import ImportExportMixin
 
+from internals.exports import BackgroundExportMixin
+
+from .backends.cached_db import evict
 from .models import User, Session, Profile, Parent, Student
-from .templatetags.users import device, location
+from .resources import ParentResource, UserResource
 
 
 class ParentInline(ImportExportMixin, admin.StackedInline):
@@ -34,7 +37,8 @@ class ProfileInline(ImportExportMixin, admin.StackedInline):
 
 
 @admin.register(Parent)
-class ParentAdmin(ImportExportMixin, admin.ModelAdmin):
+class ParentAdmin(BackgroundExportMixin, ImportExportMixin, admin.ModelAdmin):
+    resource_class = ParentResource
     list_display = ('full_name', 'phone_number_link', 'job', 'user_list')
     search_fields = ('first_name', 'last_name', 'phone_number', 'email',)
 
@@ -54,7 +58,8 @@ class ParentAdmin(ImportExportMixin, admin.ModelAdmin):
 
 
 @admin.register(User)
-class CustomUserAdmin(ImportExportMixin, UserAdmin, SimpleHistoryAdmin):
+class CustomUserAdmin(BackgroundExportMixin, ImportExportMixin, UserAdmin, SimpleHistoryAdmin):
+    resource_class = UserResource
     list_filter = UserAdmin.list_filter + ('group', 'klass', 'school')
     list_display = ('full_name', 'phone_number_link', 'date_joined')
     search_fields = ('first_name', 'last_name', 'phone_number', 'email',)
@@ -106,13 +111,13 @@ class SessionAdmin(admin.ModelAdmin):
     list_display = ('ip', 'user', 'is_valid', 'location', 'device',)
     search_fields = ('ip', 'user__id',)
     autocomplete_fields = ('user',)
-    list_filter = (ExpiredFilter,)
+    list_filter = (ExpiredFilter, 'country', 'device_label')
     exclude = ('session_key',)
-    readonly_fields = ('user', 'user_agent', 'ip',)
+    readonly_fields = ('user', 'user_agent', 'ip', 'country', 'city', 'device_label')
 
     fieldsets = (
         (None, {'fields': ('user',)}),
-        (_('User agent'), {'fields': ('user_agent', 'ip')}),
+        (_('User agent'), {'fields': ('user_agent', 'ip', 'country', 'city', 'device_label')}),
         (_('Stored data'), {'fields': ('session_data', 'expire_date')}),
     )
 
@@ -121,12 +126,25 @@ class SessionAdmin(admin.ModelAdmin):
     is_valid.boolean = True
 
     def location(self, obj):
-        return location(obj.ip)
+        return obj.get_location()
     location.short_description = _("Location")
+    location.admin_order_field = 'country'
 
     def device(self, obj):
-        return device(obj.user_agent) if obj.user_agent else '-'
-    location.short_description = _("Location")
+        return obj.device_label or '-'
+    device.short_description = _("Device")
+    device.admin_order_field = 'device_label'
+
+    def delete_model(self, request, obj):
+        # delete() resets the primary key.
+        session_key = obj.session_key
+        super(SessionAdmin, self).delete_model(request, obj)
+        evict(session_key)
+
+    def delete_queryset(self, request, queryset):
+        session_keys = list(queryset.values_list('session_key', flat=True))
+        super(SessionAdmin, self).delete_queryset(request, queryset)
+        evict(*session_keys)
 
     def get_form(self,request, obj=None, **kwargs):
         form = super().get_form(request, obj, **kwargs)
@@ -1,7 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_delete
 from django.utils.translation import ugettext_lazy as _
 
 
 class UsersConfig(AppConfig):
     name = 'users'
     verbose_name = _('Users')
+
+    def ready(self):
+        from .backends.cached_db import evict_user_sessions
+        pre_delete.connect(evict_user_sessions, sender=self.get_model('User'))
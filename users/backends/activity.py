@@ -0,0 +1,84 @@
+"""
+Coalescing buffer for session activity writes.
+
+When ``SESSION_ACTIVITY_FLUSH_INTERVAL`` is set, ``SessionStore.save_metadata``
+does not update the row itself. Changes are collected per session key (later
+requests of the same session overwrite earlier ones) and written by a
+background thread with one ``bulk_update`` per interval.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('ip', 'user_agent', 'country', 'city', 'device_label', 'last_activity')
+
+
+class ActivityBuffer(object):
+    def __init__(self, interval, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, session_key, **fields):
+        with self._lock:
+            self._pending[session_key] = fields
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='session-activity-flush', daemon=True)
+                self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Write all pending changes and return the number of updated sessions.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        sessions = [Session(session_key=key, **fields) for key, fields in pending.items()]
+        Session.objects.bulk_update(sessions, FIELDS, batch_size=self.batch_size)
+        return len(sessions)
+
+    def _run(self):
+        while not self._wakeup.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush session activity")
+            finally:
+                # Connections are per thread, do not keep an idle one open
+                # between flushes.
+                connections.close_all()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_activity_buffer():
+    """
+    Return the process-wide buffer, or None if writes are not batched.
+    """
+    global _buffer
+    interval = getattr(settings, 'SESSION_ACTIVITY_FLUSH_INTERVAL', None)
+    if not interval:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = ActivityBuffer(interval)
+            atexit.register(_buffer.flush)
+    return _buffer
+
+
+# At bottom to avoid circular import
+from ..models import Session  # noqa: E402 isort:skip
@@ -0,0 +1,223 @@
+"""
+Cached, database-backed sessions that keep the ip/user_agent tracking of
+``users.backends.db``.
+
+Sessions are looked up in a small per-process LRU first, then in the cache
+configured by ``SESSION_CACHE_ALIAS`` and only then in the database. Every
+write stores a new version of the session next to it in the shared cache, a
+record of the per-process LRU is only used while its version is the current
+one, so a worker never loads (and then saves) data older than the last write
+of another worker. Without ``SESSION_CACHE_ALIAS`` records of the per-process
+LRU are trusted for ``SESSION_LOCAL_CACHE_TIMEOUT`` seconds, which is only
+safe when a single process serves the site.
+
+Deleting sessions through the store, SessionAdmin or by deleting their user
+evicts them from the caches. Expired sessions purged in bulk are left in the
+caches, their cached records are checked against ``expire_date`` when they
+are read.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .db import METADATA_FIELDS, SessionStore as DBStore
+
+KEY_PREFIX = "users.backends.cached_db"
+
+VERSION_SUFFIX = ":version"
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache with per-entry timeout.
+    """
+    def __init__(self, maxsize=1000, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.timeout if self.timeout else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+local_cache = LRUCache(
+    maxsize=getattr(settings, 'SESSION_LOCAL_CACHE_SIZE', 1000),
+    timeout=getattr(settings, 'SESSION_LOCAL_CACHE_TIMEOUT', 5),
+)
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'SESSION_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+class SessionStore(DBStore):
+    """
+    Implements cached, database backed session store.
+    """
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None, user_agent=None, ip=None):
+        self._cache = get_shared_cache()
+        super(SessionStore, self).__init__(session_key, user_agent=user_agent, ip=ip)
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def _get_shared_record(self, local_record):
+        """
+        Returns the record of the shared cache, or local_record if it is still
+        the current version.
+        """
+        try:
+            version = self._cache.get(self.cache_key + VERSION_SUFFIX)
+            if version is None:
+                # Never cached, evicted or culled.
+                return None
+            if local_record is not None and local_record['version'] == version:
+                return local_record
+            record = self._cache.get(self.cache_key)
+        except Exception:
+            # Some backends (e.g. memcache) raise an exception on invalid
+            # cache keys. If this happens, reset the session.
+            return None
+        if record is None or record['version'] != version:
+            return None
+        local_cache.set(self.cache_key, record)
+        return record
+
+    def _get_cached_record(self):
+        record = local_cache.get(self.cache_key)
+        if self._cache is not None:
+            record = self._get_shared_record(record)
+        if record is not None and record['expire_date'] <= timezone.now():
+            return None
+        return record
+
+    def _set_cached_record(self, record):
+        record = dict(record, version=uuid.uuid4().hex)
+        local_cache.set(self.cache_key, record)
+        if self._cache is not None:
+            self._cache.set_many(
+                {self.cache_key: record, self.cache_key + VERSION_SUFFIX: record['version']},
+                self.get_expiry_age(expiry=record['expire_date']),
+            )
+
+    def _restore_from_record(self, record):
+        self._restore_metadata(
+            record['user_id'], record['last_activity'], **{f: record.get(f) for f in METADATA_FIELDS}
+        )
+
+    def load(self):
+        record = self._get_cached_record()
+        if record is None:
+            s = self._get_session_from_db()
+            if s is None:
+                self.create()
+                return {}
+            record = {
+                'data': self.decode(s.session_data),
+                'user_id': s.user_id,
+                'last_activity': s.last_activity,
+                'expire_date': s.expire_date,
+            }
+            record.update((f, getattr(s, f)) for f in METADATA_FIELDS)
+            self._set_cached_record(record)
+        self._restore_from_record(record)
+        # The record is shared with other requests of this process, never
+        # hand out the cached dictionary itself.
+        return copy.deepcopy(record['data'])
+
+    def save(self, must_create=False):
+        super(SessionStore, self).save(must_create)
+        self._set_cached_record(dict(
+            self._stored_metadata,
+            data=copy.deepcopy(self._get_session(no_load=must_create)),
+            user_id=self.user_id,
+            last_activity=self.last_activity,
+            expire_date=self.get_expiry_date(),
+        ))
+
+    def save_metadata(self):
+        super(SessionStore, self).save_metadata()
+        record = self._get_cached_record()
+        if record is not None:
+            self._set_cached_record(dict(record, last_activity=self.last_activity, **self._stored_metadata))
+
+    def delete(self, session_key=None):
+        super(SessionStore, self).delete(session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        evict(session_key)
+
+
+def evict(*session_keys):
+    """
+    Drop the sessions from the per-process LRU and the shared cache.
+    """
+    keys = [KEY_PREFIX + session_key for session_key in session_keys]
+    for key in keys:
+        local_cache.delete(key)
+    cache = get_shared_cache()
+    if cache is not None:
+        cache.delete_many(keys + [key + VERSION_SUFFIX for key in keys])
+
+
+def evict_user_sessions(sender, instance, using, **kwargs):
+    """
+    pre_delete receiver of the user model: the sessions of a user are deleted
+    by the database cascade, evict them once the deletion is committed.
+    """
+    session_keys = list(
+        Session.objects.using(using).filter(user=instance).values_list('session_key', flat=True)
+    )
+    if session_keys:
+        transaction.on_commit(lambda: evict(*session_keys), using=using)
+
+
+# At bottom to avoid circular import
+from ..models import Session  # noqa: E402 isort:skip
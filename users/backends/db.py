@@ -1,12 +1,51 @@
+import datetime
+import functools
 import logging
+import zlib
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import auth
 from django.contrib.sessions.backends.base import CreateError, SessionBase
+from django.contrib.sessions.exceptions import SuspiciousSession
+from django.core import signing
 from django.core.exceptions import SuspiciousOperation
-from django.db import IntegrityError, router, transaction
+from django.db import IntegrityError, close_old_connections, connections, router, transaction
 from django.utils import timezone
 from django.utils.encoding import force_text
 
+from ..templatetags.users import device, geolocate
+
+# Columns describing where a session is used from. country, city and
+# device_label are derived from ip and user_agent when those change.
+METADATA_FIELDS = ('ip', 'user_agent', 'country', 'city', 'device_label')
+
+
+def supports_upsert(connection):
+    """
+    Returns True if the database understands INSERT ... ON CONFLICT.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def database_sync_to_async(func):
+    """
+    sync_to_async() in the executor thread pool that closes the database
+    connections of the worker thread once func returns, the way the
+    request_finished signal does for synchronous requests.
+    """
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(inner, thread_sensitive=False)
+
 
 class SessionStore(SessionBase):
     """
@@ -18,34 +57,155 @@ class SessionStore(SessionBase):
         self.user_agent = user_agent[:200] if user_agent else user_agent
         self.ip = ip
         self.user_id = None
+        self.last_activity = None
+        # METADATA_FIELDS as stored in the database, used to write only the
+        # columns which have changed.
+        self._stored_metadata = {}
+        self.metadata_modified = False
 
     def __setitem__(self, key, value):
         if key == auth.SESSION_KEY:
             self.user_id = value
         super(SessionStore, self).__setitem__(key, value)
 
-    def load(self):
+    @property
+    def key_salt(self):
+        return 'django.contrib.sessions.' + self.__class__.__qualname__
+
+    def encode(self, session_dict):
+        """
+        Returns the given session dictionary serialized with SESSION_SERIALIZER,
+        zlib compressed if it is at least SESSION_COMPRESS_MIN_LENGTH bytes long
+        and signed as an URL-safe base64 string.
+        """
+        data = self.serializer().dumps(session_dict)
+        prefix = ''
+        min_length = getattr(settings, 'SESSION_COMPRESS_MIN_LENGTH', 1024)
+        if min_length is not None and len(data) >= min_length:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data) - 1:
+                data, prefix = compressed, '.'
+        return signing.Signer(salt=self.key_salt).sign(prefix + signing.b64_encode(data).decode())
+
+    def decode(self, session_data):
+        if ':' not in session_data:
+            # Written in the legacy base64 "hash:data" format, which never
+            # contains a colon on the outside.
+            return super(SessionStore, self).decode(session_data)
+        try:
+            value = signing.Signer(salt=self.key_salt).unsign(session_data)
+            compressed = value.startswith('.')
+            data = signing.b64_decode((value[1:] if compressed else value).encode())
+            if compressed:
+                data = zlib.decompress(data)
+            return self.serializer().loads(data)
+        except Exception as e:
+            # BadSignature, zlib and serializer errors. If any of these happen,
+            # just return an empty dictionary (an empty session).
+            if isinstance(e, signing.BadSignature):
+                e = SuspiciousSession("Session data corrupted")
+                logger = logging.getLogger('django.security.%s' % e.__class__.__name__)
+                logger.warning(str(e))
+            return {}
+
+    def _get_session_from_db(self):
         try:
-            s = Session.objects.get(
+            return Session.objects.get(
                 session_key=self.session_key,
                 expire_date__gt=timezone.now()
             )
-            self.user_id = s.user_id
-            # do not overwrite user_agent/ip, as those might have been updated
-            if self.user_agent != s.user_agent or self.ip != s.ip:
-                self.modified = True
-            return self.decode(s.session_data)
         except (Session.DoesNotExist, SuspiciousOperation) as e:
             if isinstance(e, SuspiciousOperation):
                 logger = logging.getLogger('django.security.%s' %
                                            e.__class__.__name__)
                 logger.warning(force_text(e))
+            return None
+
+    def _restore_metadata(self, user_id, last_activity=None, **metadata):
+        self.user_id = user_id
+        self.last_activity = last_activity
+        self._stored_metadata = metadata
+        # do not overwrite user_agent/ip, as those might have been updated.
+        # The row is not rewritten here, save_metadata() updates only the
+        # changed columns at most once per SESSION_ACTIVITY_UPDATE_INTERVAL.
+        self.metadata_modified = self._activity_expired()
+
+    def _activity_expired(self):
+        if self.last_activity is None:
+            return True
+        interval = datetime.timedelta(seconds=getattr(settings, 'SESSION_ACTIVITY_UPDATE_INTERVAL', 60))
+        return self.last_activity + interval <= timezone.now()
+
+    def get_metadata(self):
+        """
+        Returns ip, user_agent and the country, city and device_label derived
+        from them. Derived columns are only recomputed if ip or user_agent
+        differ from the stored ones.
+        """
+        stored = self._stored_metadata
+        metadata = {'ip': self.ip, 'user_agent': self.user_agent}
+        if 'country' in stored and stored.get('ip') == self.ip:
+            metadata['country'], metadata['city'] = stored['country'], stored['city']
+        else:
+            metadata['country'], metadata['city'] = geolocate(self.ip) if self.ip else (None, None)
+        if 'device_label' in stored and stored.get('user_agent') == self.user_agent:
+            metadata['device_label'] = stored['device_label']
+        else:
+            label = device(self.user_agent) if self.user_agent else None
+            metadata['device_label'] = str(label)[:128] if label else None
+        return metadata
+
+    def _metadata_saved(self, last_activity, metadata):
+        self.last_activity = last_activity
+        self._stored_metadata = metadata
+        self.metadata_modified = False
+
+    def load(self):
+        s = self._get_session_from_db()
+        if s is None:
             self.create()
             return {}
+        self._restore_metadata(s.user_id, s.last_activity, **{f: getattr(s, f) for f in METADATA_FIELDS})
+        return self.decode(s.session_data)
 
     def exists(self, session_key):
         return Session.objects.filter(session_key=session_key).exists()
 
+    # Asynchronous API. The ORM is synchronous only, database work runs in the
+    # executor thread pool (not in the single thread-sensitive thread) so
+    # concurrent requests do not queue up behind each other. Nothing in the
+    # request cycle closes connections of those threads, database_sync_to_async
+    # does it after every call.
+
+    async def aload(self):
+        return await database_sync_to_async(self.load)()
+
+    async def aexists(self, session_key):
+        return await database_sync_to_async(self.exists)(session_key)
+
+    async def asave(self, must_create=False):
+        await database_sync_to_async(self.save)(must_create)
+
+    async def asave_metadata(self):
+        await database_sync_to_async(self.save_metadata)()
+
+    async def adelete(self, session_key=None):
+        await database_sync_to_async(self.delete)(session_key)
+
+    async def _aget_session(self, no_load=False):
+        """
+        Asynchronous counterpart of SessionBase._get_session().
+        """
+        self.accessed = True
+        try:
+            return self._session_cache
+        except AttributeError:
+            if self.session_key is None or no_load:
+                self._session_cache = {}
+            else:
+                self._session_cache = await self.aload()
+        return self._session_cache
+
     def create(self):
         while True:
             self._session_key = self._get_new_session_key()
@@ -67,15 +227,26 @@ class SessionStore(SessionBase):
         create a *new* entry (as opposed to possibly updating an existing
         entry).
         """
+        metadata = self.get_metadata()
         obj = Session(
             session_key=self._get_or_create_session_key(),
             session_data=self.encode(self._get_session(no_load=must_create)),
             expire_date=self.get_expiry_date(),
-            user_agent=self.user_agent,
             user_id=self.user_id,
-            ip=self.ip,
+            last_activity=timezone.now(),
+            **metadata
         )
         using = router.db_for_write(Session, instance=obj)
+        if supports_upsert(connections[using]):
+            self._upsert(obj, using, must_create)
+        else:
+            self._save_instance(obj, using, must_create)
+        self._metadata_saved(obj.last_activity, metadata)
+
+    def _save_instance(self, obj, using, must_create=False):
+        """
+        Saves through the ORM: UPDATE and INSERT on a miss, in a transaction.
+        """
         try:
             with transaction.atomic(using):
                 obj.save(force_insert=must_create, using=using)
@@ -84,6 +255,54 @@ class SessionStore(SessionBase):
                 raise CreateError
             raise
 
+    def _upsert(self, obj, using, must_create=False):
+        """
+        Writes the row with a single INSERT ... ON CONFLICT statement.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        fields = Session._meta.concrete_fields
+        pk = Session._meta.pk
+        if must_create:
+            on_conflict = 'DO NOTHING'
+        else:
+            on_conflict = 'DO UPDATE SET ' + ', '.join(
+                '{0} = EXCLUDED.{0}'.format(qn(f.column)) for f in fields if not f.primary_key
+            )
+        sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) {}'.format(
+            qn(Session._meta.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join(['%s'] * len(fields)),
+            qn(pk.column),
+            on_conflict,
+        )
+        params = [f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if must_create and cursor.rowcount == 0:
+                raise CreateError
+
+    def save_metadata(self):
+        """
+        Updates last_activity and the changed METADATA_FIELDS columns without
+        rewriting session data. If SESSION_ACTIVITY_FLUSH_INTERVAL is set, the
+        update is queued and written in bulk by a background thread.
+        """
+        if self.session_key is None:
+            return
+        now = timezone.now()
+        metadata = self.get_metadata()
+        buffer = get_activity_buffer()
+        if buffer is not None:
+            buffer.add(self.session_key, last_activity=now, **metadata)
+        else:
+            changed = {
+                name: value for name, value in metadata.items()
+                if self._stored_metadata.get(name) != value
+            }
+            Session.objects.filter(session_key=self.session_key).update(last_activity=now, **changed)
+        self._metadata_saved(now, metadata)
+
     def clear(self):
         super(SessionStore, self).clear()
         self.user_id = None
@@ -102,6 +321,33 @@ class SessionStore(SessionBase):
     def clear_expired(cls):
         Session.objects.filter(expire_date__lt=timezone.now()).delete()
 
+    @classmethod
+    def iter_clear_expired(cls, chunk_size=1000):
+        """
+        Deletes expired sessions in chunks ordered by session_key and yields
+        the number of rows deleted by every chunk. Each chunk is committed on
+        its own, so an interrupted purge can simply be started again.
+        """
+        now = timezone.now()
+        using = router.db_for_write(Session)
+        last_key = ''
+        while True:
+            keys = list(
+                Session.objects.using(using)
+                .filter(expire_date__lt=now, session_key__gt=last_key)
+                .order_by('session_key')
+                .values_list('session_key', flat=True)[:chunk_size]
+            )
+            if not keys:
+                return
+            last_key = keys[-1]
+            # Sessions have no dependent rows, skip the delete collector
+            # which would load every row first.
+            yield Session.objects.using(using).filter(
+                session_key__in=keys, expire_date__lt=now
+            )._raw_delete(using)
+
 
 # At bottom to avoid circular import
 from ..models import Session  # noqa: E402 isort:skip
+from .activity import get_activity_buffer  # noqa: E402 isort:skip
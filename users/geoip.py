@@ -0,0 +1,331 @@
+"""
+Memoizing GeoIP resolver used by the ``location`` filter and sessions.
+
+The database found in ``GEOIP_PATH`` is opened once per process in
+memory-mapped mode, so forked gunicorn workers share its pages. Its type
+(City or Country) is detected when it is opened, lookups go straight to the
+matching reader method. Results, including negative ones for private and
+unknown addresses, are kept in a bounded LRU cache. When the file is
+replaced, the new database is loaded in the background and swapped in.
+
+For bulk lookups the address ranges of the database are extracted once into
+an ``IntervalIndex``, where resolving an address is a binary search.
+"""
+import ipaddress
+import os
+import threading
+import time
+import warnings
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.gis.geoip2 import HAS_GEOIP2
+
+if HAS_GEOIP2:
+    import geoip2.database
+    import maxminddb.reader
+    from geoip2.errors import AddressNotFoundError
+
+UNKNOWN = (None, None)
+
+
+def get_database_path():
+    """
+    Returns the path of the GeoIP database, a City database is preferred
+    over a Country one if GEOIP_PATH is a directory containing both.
+    """
+    path = getattr(settings, 'GEOIP_PATH', None)
+    if not path or not os.path.isdir(path):
+        return path
+    for name in (getattr(settings, 'GEOIP_CITY', 'GeoLite2-City.mmdb'),
+                 getattr(settings, 'GEOIP_COUNTRY', 'GeoLite2-Country.mmdb')):
+        if os.path.isfile(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+class IntervalIndex(object):
+    """
+    Country of every address range of a GeoIP database in sorted arrays.
+
+    Ranges are consecutive and cover the whole address space, gaps are
+    stored as ranges with an unknown country. IPv4 ranges are kept apart
+    from IPv6 ones so their starts fit into a compact unsigned int array.
+    """
+    def __init__(self):
+        self.names = [None]
+        self._name_ids = {None: 0}
+        self.ipv4 = (array('I'), array('H'))
+        self.ipv6 = ([], array('H'))
+        self._next = {id(self.ipv4): 0, id(self.ipv6): 1 << 32}
+
+    def __len__(self):
+        return len(self.ipv4[0]) + len(self.ipv6[0])
+
+    def _add(self, start, end, name):
+        table = self.ipv4 if end < 1 << 32 else self.ipv6
+        starts, values = table
+        expected = self._next[id(table)]
+        if start > expected:
+            self._append(starts, values, expected, 0)
+        value = self._name_ids.setdefault(name, len(self.names))
+        if value == len(self.names):
+            self.names.append(name)
+        self._append(starts, values, start, value)
+        self._next[id(table)] = end + 1
+
+    def _finish(self):
+        # Addresses after the last network of each table are unknown.
+        for table, end in ((self.ipv4, 1 << 32), (self.ipv6, 1 << 128)):
+            if self._next[id(table)] < end:
+                self._append(table[0], table[1], self._next[id(table)], 0)
+
+    def _append(self, starts, values, start, value):
+        # Adjacent ranges of the same country are merged.
+        if not values or values[-1] != value:
+            starts.append(start)
+            values.append(value)
+
+    @classmethod
+    def from_database(cls, path):
+        """
+        Walks the search tree of the database and collects its networks.
+        """
+        reader = maxminddb.reader.Reader(path, maxminddb.MODE_MMAP)
+        try:
+            metadata = reader.metadata()
+            node_count = metadata.node_count
+            bits = 128 if metadata.ip_version == 6 else 32
+            # IPv4 networks live under ::/96, other aliases of that subtree
+            # (::ffff:0:0/96, 2002::/16) must not be walked again.
+            ipv4_start = reader._start_node(32) if bits == 128 else None
+            names = {}
+            index = cls()
+            stack = [(0, 0, 0)]
+            while stack:
+                node, depth, prefix = stack.pop()
+                if node > node_count:
+                    if node not in names:
+                        record = reader._resolve_data_pointer(node)
+                        names[node] = record.get('country', {}).get('names', {}).get('en')
+                    start = prefix << (bits - depth)
+                    index._add(start, start + (1 << (bits - depth)) - 1, names[node])
+                elif node < node_count:
+                    if prefix and node == ipv4_start:
+                        continue
+                    stack.append((reader._read_node(node, 1), depth + 1, (prefix << 1) | 1))
+                    stack.append((reader._read_node(node, 0), depth + 1, prefix << 1))
+        finally:
+            reader.close()
+        index._finish()
+        return index
+
+    def country(self, address):
+        """
+        Returns the country name of an ipaddress.IPv4Address/IPv6Address.
+        """
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        starts, values = self.ipv4 if address.version == 4 else self.ipv6
+        i = bisect_right(starts, int(address)) - 1
+        return self.names[values[i]] if i >= 0 else None
+
+
+class GeoIPDatabase(object):
+    """
+    An opened GeoIP database with its lookup cache and interval index.
+    """
+    def __init__(self, path, cache_size=10000):
+        self.path = path
+        self.signature = get_signature(path)
+        self.reader = geoip2.database.Reader(path, mode=geoip2.database.MODE_MMAP)
+        self.database_type = self.reader.metadata().database_type
+        self.has_city = 'City' in self.database_type
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    def _lookup(self, value):
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            return UNKNOWN
+        if not address.is_global:
+            return UNKNOWN
+        try:
+            if self.has_city:
+                response = self.reader.city(value)
+                return response.country.name, response.city.name
+            return self.reader.country(value).country.name, None
+        except AddressNotFoundError:
+            return UNKNOWN
+
+    def get_index(self):
+        """
+        Returns the interval index of the database, built on first use.
+        """
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = IntervalIndex.from_database(self.path)
+        return self._index
+
+    def countries(self, values):
+        """
+        Resolves a sequence of IP addresses into a list of country names.
+        """
+        index = self.get_index()
+        result = []
+        for value in values:
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                result.append(None)
+            else:
+                result.append(index.country(address))
+        return result
+
+    def stats(self):
+        info = self.lookup.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': info.maxsize,
+        }
+
+    def close(self):
+        self.reader.close()
+
+
+def get_signature(path):
+    """
+    Identifies a version of the database file. New files must be moved into
+    place (as geoipupdate does), writing into the file the current reader
+    has memory-mapped would corrupt its lookups.
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class GeoIPResolver(object):
+    """
+    Resolves IP addresses into (country, city) tuples.
+
+    Every ``reload_interval`` seconds a lookup checks whether the database
+    file was replaced. A new file is opened in a background thread, with its
+    interval index if the current one has been built, and then swapped in
+    with a single assignment. The lookup cache belongs to the database, so
+    it is dropped along with the old one. Until the swap lookups keep using
+    the old database, which is not closed explicitly as requests running at
+    the time of the swap may still hold it.
+    """
+    def __init__(self, path, cache_size=10000, reload_interval=None):
+        self.path = path
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.database = GeoIPDatabase(path, cache_size)
+        self._signature = self.database.signature
+        self._next_check = time.monotonic() + (reload_interval or 0)
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+
+    @property
+    def database_type(self):
+        return self.database.database_type
+
+    def lookup(self, value):
+        self.check_reload()
+        return self.database.lookup(value)
+
+    def get_index(self):
+        self.check_reload()
+        return self.database.get_index()
+
+    def countries(self, values):
+        self.check_reload()
+        return self.database.countries(values)
+
+    def stats(self):
+        return self.database.stats()
+
+    def close(self):
+        self.database.close()
+
+    def check_reload(self):
+        if not self.reload_interval or time.monotonic() < self._next_check:
+            return
+        # Only one thread checks the file and starts a reload at a time, the
+        # others carry on with the current database.
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.reload_interval
+            if self._reloading:
+                return
+            try:
+                signature = get_signature(self.path)
+            except OSError:
+                return
+            if signature == self._signature:
+                return
+            # A file which fails to load is not retried until it changes.
+            self._signature = signature
+            self._reloading = True
+        finally:
+            self._reload_lock.release()
+        threading.Thread(target=self.reload, name='geoip-reload', daemon=True).start()
+
+    def reload(self):
+        """
+        Opens the database file again and swaps it in.
+        """
+        try:
+            database = GeoIPDatabase(self.path, self.cache_size)
+            if self.database._index is not None:
+                database.get_index()
+        except Exception as e:
+            warnings.warn(f"Could not reload GeoIP database {self.path}: {e}")
+        else:
+            self.database = database
+        finally:
+            self._reloading = False
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """
+    Returns the process-wide resolver, or None if GeoIP is unavailable.
+    """
+    global _resolver
+    if _resolver is None and HAS_GEOIP2:
+        with _resolver_lock:
+            if _resolver is None:
+                path = get_database_path()
+                try:
+                    _resolver = GeoIPResolver(
+                        path,
+                        cache_size=getattr(settings, 'GEOIP_CACHE_SIZE', 10000),
+                        reload_interval=getattr(settings, 'GEOIP_RELOAD_INTERVAL', None),
+                    )
+                except Exception as e:
+                    warnings.warn(f"Could not open GeoIP database {path}: {e}")
+                    # Do not retry on every lookup.
+                    _resolver = False
+    return _resolver or None
+
+
+def countries(values):
+    """
+    Resolves a sequence of IP addresses into a list of country names, None
+    for unknown addresses or if GeoIP is unavailable.
+    """
+    resolver = get_resolver()
+    if resolver is None:
+        return [None] * len(values)
+    return resolver.countries(values)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from users.models import Session
+from users.templatetags.users import geolocate
+from users.useragents import labels
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Fills country, city and device_label of existing sessions in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            default=1000,
+            type=int,
+            help="Number of sessions updated per query"
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute all sessions, not only those with missing columns"
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        queryset = Session.objects.all()
+        if not options["all"]:
+            queryset = queryset.filter(
+                Q(country__isnull=True, ip__isnull=False) | Q(device_label__isnull=True, user_agent__isnull=False)
+            )
+
+        started = time.monotonic()
+        total = 0
+        last_key = ''
+        while True:
+            sessions = list(
+                queryset.filter(session_key__gt=last_key)
+                .order_by('session_key')
+                .only('session_key', 'ip', 'user_agent')[:batch_size]
+            )
+            if not sessions:
+                break
+            last_key = sessions[-1].session_key
+            device_labels = labels([session.user_agent for session in sessions])
+            for session, label in zip(sessions, device_labels):
+                # geolocate() goes through the bounded LRU of the GeoIP resolver.
+                session.country, session.city = geolocate(session.ip) if session.ip else (None, None)
+                session.device_label = str(label)[:128] if label else None
+            Session.objects.bulk_update(sessions, ('country', 'city', 'device_label'))
+            total += len(sessions)
+            self.stdout.write(f"Updated {total} sessions ({total / (time.monotonic() - started):.0f} rows/s)")
+        self.stdout.write(f"Done, updated {total} sessions")
@@ -0,0 +1,63 @@
+from django.contrib.gis.geoip2 import GeoIP2
+from django.core.management.base import BaseCommand, CommandError
+
+from users.geoip import get_database_path, get_resolver
+
+import ipaddress
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = "Benchmarks per-IP GeoIP2 lookups against the batch interval index"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            default=50000,
+            type=int,
+            help="Number of IP addresses to resolve"
+        )
+        parser.add_argument(
+            "--seed",
+            default=0,
+            type=int,
+            help="Seed of the random address generator"
+        )
+
+    def handle(self, *args, **options):
+        resolver = get_resolver()
+        if resolver is None:
+            raise CommandError("GeoIP database is not available, check GEOIP_PATH")
+
+        rng = random.Random(options["seed"])
+        ips = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for i in range(options["count"])]
+        self.stdout.write(f"Database: {get_database_path()} ({resolver.database_type}), {len(ips)} addresses")
+
+        geoip = GeoIP2(get_database_path())
+        started = time.perf_counter()
+        expected = []
+        for ip in ips:
+            try:
+                expected.append(geoip.country(ip)['country_name'])
+            except Exception:
+                expected.append(None)
+        self.report("GeoIP2().country()", started, len(ips))
+
+        started = time.perf_counter()
+        index = resolver.get_index()
+        self.stdout.write(
+            f"  - index build: {time.perf_counter() - started:.2f}s, "
+            f"{len(index)} ranges, {len(index.names) - 1} countries"
+        )
+
+        started = time.perf_counter()
+        result = resolver.countries(ips)
+        self.report("countries()", started, len(ips))
+
+        mismatches = sum(1 for a, b in zip(expected, result) if a != b)
+        self.stdout.write(f"Mismatches: {mismatches}")
+
+    def report(self, name, started, count):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"  - {name:20}: {elapsed:.2f}s, {count / elapsed:.0f} lookups/s")
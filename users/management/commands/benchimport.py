@@ -0,0 +1,129 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+
+from import_export import resources
+
+from internals.models import School
+from users.models import Parent, User
+from users.resources import UserResource
+
+import copy
+import random
+import time
+
+import tablib
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks importing a user roster with the row by row ModelResource against the bulk UserResource. "
+        "Both imports are dry runs, nothing is written. Diffs are skipped unless --diff is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            default=10000,
+            type=int,
+            help="Number of rows of the roster"
+        )
+        parser.add_argument(
+            "--baseline-rows",
+            default=1000,
+            type=int,
+            help="Number of rows imported with the row by row ModelResource, its speed is extrapolated"
+        )
+        parser.add_argument(
+            "--without-ids",
+            action="store_true",
+            help="Leave the id column of new users empty"
+        )
+        parser.add_argument(
+            "--diff",
+            action="store_true",
+            help="Compute the diffs of the rows, as imports in the admin do for their preview"
+        )
+        parser.add_argument(
+            "--seed",
+            default=0,
+            type=int,
+            help="Seed of the random roster generator"
+        )
+
+    def handle(self, *args, **options):
+        dataset = self.get_roster(options["rows"], options["without_ids"], random.Random(options["seed"]))
+        self.stdout.write(
+            f"{len(dataset)} rows, {User.objects.count()} users, "
+            f"{School.objects.count()} schools, {Parent.objects.count()} parents"
+        )
+
+        baseline = tablib.Dataset(*dataset[:options["baseline_rows"]], headers=dataset.headers)
+        rate = self.run("ModelResource", self.get_resource(resources.modelresource_factory(User), options["diff"]), baseline)
+        bulk_rate = self.run("UserResource", self.get_resource(UserResource, options["diff"]), dataset)
+        self.stdout.write(f"Speedup: {bulk_rate / rate:.1f}x")
+
+    def get_resource(self, resource_class, diff):
+        resource = resource_class()
+        if not diff:
+            resource._meta = copy.copy(resource._meta)
+            resource._meta.skip_diff = True
+        return resource
+
+    def get_roster(self, count, without_ids, rng):
+        """
+        Returns a dataset as an export of UserResource, a tenth of the rows
+        update existing users, the others are new.
+        """
+        resource = UserResource()
+        dataset = resource.export(User.objects.order_by('pk')[:max(count // 10, 1)])
+        headers = dataset.headers
+        school_ids = list(School.objects.values_list('pk', flat=True)) or ['']
+        parent_ids = list(Parent.objects.values_list('pk', flat=True))
+        next_id = (User.objects.aggregate(id=Max('pk'))['id'] or 0) + 1
+        while len(dataset) < count:
+            row = dict.fromkeys(headers, '')
+            row.update({
+                'id': '' if without_ids else next_id,
+                'username': f"bench{next_id}",
+                'first_name': rng.choice(["Ivan", "Anna", "Petr", "Maria"]),
+                'last_name': rng.choice(["Ivanov", "Petrova", "Sidorov", "Kozlova"]),
+                'sex': rng.choice(["male", "female"]),
+                'phone_number': f"+37529{rng.randrange(10 ** 7):07d}",
+                'group': rng.choice(["junior", "middle", "senior"]),
+                'birthday': "2005-01-01",
+                'date_joined': "2020-09-01 00:00:00",
+                'school': rng.choice(school_ids),
+                'klass': rng.randrange(1, 12),
+                'parents': ','.join(str(pk) for pk in rng.sample(parent_ids, min(len(parent_ids), 2))),
+                'is_active': 1,
+                'is_staff': 0,
+                'is_superuser': 0,
+            })
+            dataset.append([row[header] for header in headers])
+            next_id += 1
+        return dataset
+
+    def run(self, name, resource, dataset):
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            started = time.perf_counter()
+            result = resource.import_data(dataset, dry_run=True, use_transactions=True)
+            elapsed = time.perf_counter() - started
+        if result.has_errors() or result.has_validation_errors():
+            error = result.base_errors[0].error if result.base_errors else None
+            for row in result.rows:
+                if row.errors:
+                    error = row.errors[0].error
+                    break
+            raise CommandError(f"{name} import failed: {error or result.invalid_rows[0].error}")
+        self.stdout.write(
+            f"  - {name:14}: {len(dataset)} rows in {elapsed:.2f}s, {len(dataset) / elapsed:.0f} rows/s, "
+            f"{len(queries)} queries"
+        )
+        return len(dataset) / elapsed
@@ -0,0 +1,188 @@
+from asgiref.sync import sync_to_async
+from django.contrib.messages import constants
+from django.contrib.messages.storage.base import Message
+from django.contrib.messages.storage.cookie import MessageEncoder
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from users.backends.db import SessionStore
+from users.models import Session
+
+import asyncio
+import hashlib
+import statistics
+import time
+
+
+def summary(timings):
+    return (
+        f"mean {statistics.mean(timings):.3f} ms, "
+        f"p95 {sorted(timings)[int(len(timings) * 0.95)]:.3f} ms"
+    )
+
+
+class Command(BaseCommand):
+    help = "Benchmarks session store implementations (writes to the configured database)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode",
+            default="save",
+            choices=["save", "concurrency", "encoding"],
+            help=(
+                "save: ORM save vs upsert, concurrency: sync vs async database session loading under asyncio, "
+                "encoding: legacy vs compact session payload encoding"
+            )
+        )
+        parser.add_argument(
+            "--iterations",
+            default=500,
+            type=int,
+            help="Number of saves, requests or encodings per implementation"
+        )
+        parser.add_argument(
+            "--concurrency",
+            default=50,
+            type=int,
+            help="Number of concurrent requests in concurrency mode"
+        )
+
+    def handle(self, *args, **options):
+        if options["mode"] == "concurrency":
+            self.bench_concurrency(options["iterations"], options["concurrency"])
+        elif options["mode"] == "encoding":
+            self.bench_encoding(options["iterations"])
+        else:
+            self.bench_save(options["iterations"])
+
+    def bench_save(self, iterations):
+        using = router.db_for_write(Session)
+        connection = connections[using]
+
+        def build(store, must_create):
+            obj = Session(
+                session_key=store._get_or_create_session_key(),
+                session_data=store.encode(store._get_session(no_load=must_create)),
+                expire_date=store.get_expiry_date(),
+                user_agent=store.user_agent,
+                user_id=store.user_id,
+                ip=store.ip,
+                last_activity=timezone.now(),
+            )
+            return obj
+
+        def orm_save(store, must_create):
+            store._save_instance(build(store, must_create), using, must_create)
+
+        def upsert_save(store, must_create):
+            store._upsert(build(store, must_create), using, must_create)
+
+        self.stdout.write(f"Database: {connection.vendor}, {iterations} iterations")
+        for name, save in (("orm", orm_save), ("upsert", upsert_save)):
+            keys = []
+            for must_create in (True, False):
+                timings = []
+                statements = 0
+                with CaptureQueriesContext(connection) as queries:
+                    for i in range(iterations):
+                        if must_create:
+                            store = SessionStore(ip='127.0.0.1', user_agent='benchsessions')
+                            store._session_key = store._get_new_session_key()
+                            keys.append(store._session_key)
+                        else:
+                            store = SessionStore(keys[i], ip='127.0.0.1', user_agent='benchsessions')
+                        store._session_cache = {}
+                        store['counter'] = i
+                        executed = len(queries)
+                        started = time.perf_counter()
+                        save(store, must_create)
+                        timings.append((time.perf_counter() - started) * 1000)
+                        statements += len(queries) - executed
+                label = "create" if must_create else "update"
+                self.stdout.write(f"  - {name:6} {label}: {statements / iterations:.2f} statements/save, {summary(timings)}")
+            Session.objects.filter(session_key__in=keys).delete()
+
+    def bench_concurrency(self, iterations, concurrency):
+        # Always users.backends.db, so both paths load the session from the
+        # database instead of the caches of users.backends.cached_db.
+        keys = []
+        for i in range(concurrency):
+            store = SessionStore(ip='127.0.0.1', user_agent='benchsessions')
+            store['counter'] = i
+            store.save()
+            keys.append(store.session_key)
+
+        def load_sync(key):
+            store = SessionStore(key, ip='127.0.0.1', user_agent='benchsessions')
+            return store._get_session()
+
+        async def sync_path(key):
+            # What a synchronous middleware costs under ASGI: every call is
+            # handed to the single thread-sensitive thread.
+            await sync_to_async(load_sync, thread_sensitive=True)(key)
+
+        async def async_path(key):
+            store = SessionStore(key, ip='127.0.0.1', user_agent='benchsessions')
+            await store._aget_session()
+
+        async def run(path):
+            semaphore = asyncio.Semaphore(concurrency)
+            timings = []
+
+            async def request(key):
+                async with semaphore:
+                    started = time.perf_counter()
+                    await path(key)
+                    timings.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(request(keys[i % len(keys)]) for i in range(iterations)))
+            return iterations / (time.perf_counter() - started), timings
+
+        self.stdout.write(f"Engine: users.backends.db, {iterations} requests, concurrency {concurrency}")
+        for name, path in (("sync", sync_path), ("async", async_path)):
+            throughput, timings = asyncio.run(run(path))
+            self.stdout.write(f"  - {name:5}: {throughput:.0f} requests/s, {summary(timings)}")
+        Session.objects.filter(session_key__in=keys).delete()
+
+    def bench_encoding(self, iterations):
+        login = {
+            '_auth_user_id': '1',
+            '_auth_user_backend': 'django.contrib.auth.backends.ModelBackend',
+            '_auth_user_hash': hashlib.sha1(b'benchsessions').hexdigest(),
+        }
+        messages = MessageEncoder(separators=(',', ':')).encode([
+            Message(constants.SUCCESS, f'The user “Иванов Иван Иванович (ID: {i}, +375291234567)” was changed successfully.')
+            for i in range(10)
+        ])
+        payloads = (
+            ("login", login),
+            ("messages", dict(login, _messages=messages)),
+            ("bulk action", dict(login, _messages=messages, selected=[str(i) for i in range(5000)])),
+        )
+        store = SessionStore()
+        implementations = (
+            ("legacy", lambda d: SessionBase.encode(store, d), lambda s: SessionBase.decode(store, s)),
+            ("compact", store.encode, store.decode),
+        )
+
+        self.stdout.write(f"{iterations} iterations")
+        for label, payload in payloads:
+            self.stdout.write(f"  - {label}")
+            for name, encode, decode in implementations:
+                encode_timings, decode_timings = [], []
+                for i in range(iterations):
+                    started = time.perf_counter()
+                    encoded = encode(payload)
+                    encode_timings.append((time.perf_counter() - started) * 1000)
+                    started = time.perf_counter()
+                    decode(encoded)
+                    decode_timings.append((time.perf_counter() - started) * 1000)
+                assert decode(encoded) == payload
+                self.stdout.write(
+                    f"    - {name:7}: {len(encoded)} bytes, "
+                    f"encode {summary(encode_timings)}, decode {summary(decode_timings)}"
+                )
@@ -0,0 +1,125 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import translation
+
+from users.useragents import BROWSERS, DEVICES, UserAgentClassifier, format_label
+
+import random
+import re
+import time
+
+# User agents with the labels they are expected to get.
+CORPUS = (
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/86.0.4240.111 Safari/537.36', 'Chrome on Windows 10'),
+    ('Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:82.0) Gecko/20100101 Firefox/82.0', 'Firefox on Windows 7'),
+    ('Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/70.0.3538.102 Safari/537.36 OPR/57.0.3098.116', 'Chrome on Windows 8.1'),
+    ('Mozilla/5.0 (Windows NT 5.1) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/49.0.2623.112 Safari/537.36', 'Chrome on Windows XP'),
+    ('Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0; Trident/4.0)', 'Internet Explorer on Windows Vista'),
+    ('Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Trident/6.0)', 'Internet Explorer on Windows 8'),
+    ('Opera/9.80 (Windows NT 6.1; U; ru) Presto/2.10.289 Version/12.02', 'Opera on Windows 7'),
+    ('Mozilla/5.0 (Windows; U; Windows CE) Gecko/20100101 Firefox/3.6', 'Firefox on Windows'),
+    ('Mozilla/5.0 (Linux; Android 10; SM-A505FN) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/86.0.4240.114 Mobile Safari/537.36', 'Chrome on Android'),
+    ('Mozilla/5.0 (Linux; Android 9; Redmi Note 7) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Version/4.0 Chrome/85.0.4183.127 YaBrowser/20.9.3.85.00 Mobile Safari/537.36', 'Chrome on Android'),
+    ('Mozilla/5.0 (Android 10; Mobile; rv:82.0) Gecko/82.0 Firefox/82.0', 'Firefox on Android'),
+    ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/86.0.4240.75 Safari/537.36', 'Chrome on Linux'),
+    ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:81.0) Gecko/20100101 Firefox/81.0', 'Firefox on Linux'),
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 14_0_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+     'Version/14.0 Mobile/15E148 Safari/604.1', 'Safari on iPhone'),
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 13_7 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+     'CriOS/86.0.4240.93 Mobile/15E148 Safari/604.1', 'Safari on iPhone'),
+    ('Mozilla/5.0 (iPad; CPU OS 12_4_8 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+     'Version/12.1.2 Mobile/15E148 Safari/604.1', 'Safari on iPad'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_5) AppleWebKit/600.8.9 (KHTML, like Gecko) '
+     'Version/7.1.8 Safari/537.85.17', 'Safari on OS X Mavericks'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/603.3.8 (KHTML, like Gecko) '
+     'Version/10.1.2 Safari/603.3.8', 'Safari on OS X Yosemite'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.11; rv:78.0) Gecko/20100101 Firefox/78.0',
+     'Firefox on OS X El Capitan'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/79.0.3945.130 Safari/537.36', 'Chrome on macOS Sierra'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_6) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+     'Version/13.1.2 Safari/605.1.15', 'Safari on macOS High Sierra'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+     'Version/14.0 Safari/605.1.15', 'Safari on macOS Mojave'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) '
+     'Chrome/86.0.4240.111 Safari/537.36', 'Chrome on macOS Catalina'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 11.0; rv:82.0) Gecko/20100101 Firefox/82.0',
+     'Firefox on macOS Big Sur'),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 12.6; rv:105.0) Gecko/20100101 Firefox/105.0',
+     'Firefox on macOS Monterey'),
+    ('Mozilla/5.0 (Macintosh; PPC Mac OS X 10_5_8) AppleWebKit/534.50.2 (KHTML, like Gecko) '
+     'Version/5.0.6 Safari/533.22.3', 'Safari on OS X'),
+    ('curl/7.68.0', None),
+    ('python-requests/2.24.0', None),
+    ('Googlebot/2.1 (+http://www.google.com/bot.html)', None),
+)
+
+
+def classify_sequential(value):
+    """
+    The original classifier: one search per pattern until the first match.
+    """
+    found = []
+    for table in SEQUENTIAL_TABLES:
+        found.append(next((label for regex, label in table if regex.search(value)), None))
+    return tuple(found)
+
+
+SEQUENTIAL_TABLES = tuple(
+    tuple((re.compile(pattern), label) for pattern, label in table)
+    for table in (BROWSERS, DEVICES)
+)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the user agent classifier on a corpus of user agents with expected labels"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            default=100000,
+            type=int,
+            help="Number of user agents to classify, drawn from the corpus with a skewed distribution"
+        )
+        parser.add_argument(
+            "--seed",
+            default=0,
+            type=int,
+            help="Seed of the random generator"
+        )
+
+    def handle(self, *args, **options):
+        translation.activate('en')
+        failures = 0
+        for value, expected in CORPUS:
+            for name, classify in (("sequential", classify_sequential),
+                                   ("single-pass", UserAgentClassifier()._classify)):
+                label = format_label(*classify(value))
+                if (str(label) if label else None) != expected:
+                    failures += 1
+                    self.stderr.write(f"{name}: {value!r} is {label!r}, expected {expected!r}")
+        self.stdout.write(f"Corpus: {len(CORPUS)} user agents, {failures} wrong labels")
+        if failures:
+            raise CommandError("The corpus has wrong labels")
+
+        rng = random.Random(options["seed"])
+        # Real traffic is dominated by a few user agents.
+        weights = [1 / (rank + 1) for rank in range(len(CORPUS))]
+        values = [value for value, expected in rng.choices(CORPUS, weights, k=options["count"])]
+
+        uncached, cached, batch = UserAgentClassifier(), UserAgentClassifier(), UserAgentClassifier()
+        for name, classify in (
+            ("sequential", lambda values: [classify_sequential(value) for value in values]),
+            ("single-pass", lambda values: [uncached._classify(value) for value in values]),
+            ("cached", lambda values: [cached.classify(value) for value in values]),
+            ("batch", batch.classify_many),
+        ):
+            started = time.perf_counter()
+            classify(values)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"  - {name:11}: {elapsed:.3f}s, {len(values) / elapsed:.0f} user agents/s")
@@ -1 +1,50 @@
-from django.contrib.sessions.management.commands.clearsessions import Command  # flake8: noqa isort:skip
+from django.conf import settings
+from django.contrib.sessions.management.commands import clearsessions
+
+from importlib import import_module
+import time
+
+
+class Command(clearsessions.Command):
+    help = (
+        "Can be run as a cronjob or directly to clean out expired sessions "
+        "(only with the database backend at the moment). With --chunk-size "
+        "sessions are deleted in batches, the purge can be interrupted and "
+        "started again at any time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            default=None,
+            type=int,
+            help="Delete expired sessions in batches of this size"
+        )
+        parser.add_argument(
+            "--sleep",
+            default=0.0,
+            type=float,
+            help="Seconds to sleep between batches"
+        )
+
+    def handle(self, **options):
+        chunk_size = options["chunk_size"]
+        if not chunk_size:
+            return super(Command, self).handle(**options)
+
+        engine = import_module(settings.SESSION_ENGINE)
+        if not hasattr(engine.SessionStore, 'iter_clear_expired'):
+            self.stderr.write(
+                "Session engine '%s' doesn't support chunked clearing of expired sessions." % settings.SESSION_ENGINE
+            )
+            return
+
+        started = time.monotonic()
+        total = 0
+        for deleted in engine.SessionStore.iter_clear_expired(chunk_size=chunk_size):
+            total += deleted
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"Deleted {total} sessions ({total / elapsed if elapsed else 0:.0f} rows/s)")
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(f"Done, deleted {total} expired sessions in {time.monotonic() - started:.1f}s")
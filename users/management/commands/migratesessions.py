@@ -1,10 +1,16 @@
 # -*- coding: UTF-8 -*-
 import importlib
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
+import django
+from django.contrib import auth
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
-from user_sessions.models import Session as UserSession
+
+from internals.utils import chunked
+from users.backends.db import SessionStore
+from users.models import Session as UserSession
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +28,10 @@ def get_model_class(full_model_name):
         raise
 
 
+def decode_user_id(session_data):
+    return SessionStore().decode(session_data).get(auth.SESSION_KEY)
+
+
 class Command(BaseCommand):
     """
     Convert existing (old) sessions to the user_sessions SessionStore.
@@ -37,8 +47,31 @@ class Command(BaseCommand):
             default='django.contrib.sessions.models.Session',
             help='Existing session model to migrate to the new UserSessions database table'
         )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Stream old sessions in chunks and insert them with bulk_create'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            default=2000,
+            type=int,
+            help='Number of sessions per chunk in bulk mode'
+        )
+        parser.add_argument(
+            '--processes',
+            default=1,
+            type=int,
+            help='Number of processes decoding session data in bulk mode'
+        )
 
     def handle(self, *args, **options):
+        if options['bulk']:
+            return self.handle_bulk(
+                get_model_class(options['oldmodel']), options['chunk_size'], options['processes']
+            )
+
         User = get_user_model()
         old_sessions = get_model_class(options['oldmodel']).objects.all()
         logger.info("Processing %d session objects" % old_sessions.count())
@@ -59,3 +92,38 @@ class Command(BaseCommand):
                 conversion_count += 1
 
         logger.info("Created %d new session objects" % conversion_count)
+
+    def handle_bulk(self, old_model, chunk_size, processes):
+        User = get_user_model()
+        pool = ProcessPoolExecutor(processes, initializer=django.setup) if processes > 1 else None
+        initial_count = UserSession.objects.count()
+        old_sessions = old_model.objects.order_by('pk').values_list(
+            'session_key', 'session_data', 'expire_date'
+        ).iterator(chunk_size=chunk_size)
+        processed = 0
+        try:
+            for chunk in chunked(old_sessions, chunk_size):
+                session_data = [data for _, data, _ in chunk]
+                if pool:
+                    user_ids = list(pool.map(decode_user_id, session_data, chunksize=max(1, len(chunk) // processes)))
+                else:
+                    user_ids = [decode_user_id(data) for data in session_data]
+                user_ids = [User._meta.pk.to_python(i) if i is not None else None for i in user_ids]
+                existing_ids = User.objects.only('pk').in_bulk({i for i in user_ids if i is not None}).keys()
+                UserSession.objects.bulk_create([
+                    UserSession(
+                        session_key=session_key,
+                        session_data=data,
+                        expire_date=expire_date,
+                        user_id=user_id if user_id in existing_ids else None,
+                        ip='127.0.0.1'
+                    )
+                    for (session_key, data, expire_date), user_id in zip(chunk, user_ids)
+                ], ignore_conflicts=True)
+                processed += len(chunk)
+                logger.info("Processed %d session objects" % processed)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        logger.info("Created %d new session objects" % (UserSession.objects.count() - initial_count))
@@ -0,0 +1,93 @@
+import csv
+import json
+import sys
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from internals.utils import chunked
+from users.geoip import countries
+from users.models import Session
+from users.useragents import classifier
+
+DIMENSIONS = ('country', 'device', 'browser', 'group', 'hour')
+
+
+class Command(BaseCommand):
+    help = (
+        "Counts active sessions by country, device, browser, user group and hour "
+        "of last activity, streaming the session table in chunks"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            default="csv",
+            choices=["csv", "json"],
+            help="Output format"
+        )
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="File to write the report to, standard output by default"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            default=2000,
+            type=int,
+            help="Number of sessions fetched and classified at a time"
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Include expired sessions"
+        )
+
+    def handle(self, *args, **options):
+        queryset = Session.objects.all()
+        if not options["all"]:
+            queryset = queryset.filter(expire_date__gt=timezone.now())
+        rows = queryset.values_list('ip', 'country', 'user_agent', 'last_activity', 'user__group')
+
+        counters = {dimension: Counter() for dimension in DIMENSIONS}
+        started = time.monotonic()
+        total = 0
+        # A server-side cursor where the database supports it, only one chunk
+        # of rows is held in memory at a time.
+        for chunk in chunked(rows.iterator(chunk_size=options["chunk_size"]), options["chunk_size"]):
+            ips, stored_countries, user_agents, activity, groups = zip(*chunk)
+            # Countries are resolved only for sessions saved before they were stored.
+            missing = [ip for ip, country in zip(ips, stored_countries) if country is None and ip]
+            resolved = iter(countries(missing))
+            user_agents = classifier.classify_many(user_agents)
+            for ip, country, (browser, device), last_activity, group in zip(
+                    ips, stored_countries, user_agents, activity, groups):
+                if country is None and ip:
+                    country = next(resolved)
+                counters['country'][country] += 1
+                counters['device'][str(device) if device else None] += 1
+                counters['browser'][str(browser) if browser else None] += 1
+                counters['group'][group] += 1
+                counters['hour'][timezone.localtime(last_activity).hour if last_activity else None] += 1
+            total += len(chunk)
+
+        output = open(options["output"], 'w', newline='') if options["output"] else sys.stdout
+        try:
+            if options["format"] == "json":
+                json.dump({
+                    'sessions': total,
+                    **{dimension: dict(counter.most_common()) for dimension, counter in counters.items()},
+                }, output, ensure_ascii=False, indent=2)
+                output.write('\n')
+            else:
+                writer = csv.writer(output)
+                writer.writerow(('dimension', 'value', 'sessions'))
+                for dimension, counter in counters.items():
+                    for value, count in counter.most_common():
+                        writer.writerow((dimension, value, count))
+        finally:
+            if options["output"]:
+                output.close()
+        self.stderr.write(f"Counted {total} sessions in {time.monotonic() - started:.1f}s")
@@ -1,7 +1,11 @@
+import logging
+import threading
 import time
+from collections import Counter
 
 from django.conf import settings
 from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject, empty
 from django.utils.http import http_date
 
 try:
@@ -16,51 +20,155 @@ except ImportError:
         pass
 
 
+logger = logging.getLogger(__name__)
+
+
+class SessionStats(object):
+    """
+    Process-wide counters of SessionMiddleware.
+
+    * requests - requests seen by the middleware
+    * touched - requests which read or wrote the session
+    * saved - requests which saved the whole session
+    * metadata_saved - requests which only updated ip/user_agent/last_activity
+
+    The counters are logged every SESSION_STATS_LOG_INTERVAL seconds, if set.
+    """
+    def __init__(self):
+        self._counter = Counter()
+        self._lock = threading.Lock()
+        self._logged = time.monotonic()
+
+    def incr(self, name):
+        with self._lock:
+            self._counter[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counter)
+
+    def reset(self):
+        with self._lock:
+            self._counter.clear()
+
+    def log(self, interval):
+        """
+        Logs the counters if the last time was at least ``interval`` seconds
+        ago.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._logged < interval:
+                return
+            self._logged = now
+            stats = dict(self._counter)
+        requests = stats.get('requests', 0)
+        logger.info(
+            "Sessions: %d requests, %d touched (%.0f%%), %d saved, %d metadata saved",
+            requests, stats.get('touched', 0), stats.get('touched', 0) * 100 / requests if requests else 0,
+            stats.get('saved', 0), stats.get('metadata_saved', 0),
+            extra={'session_stats': stats},
+        )
+
+
+session_stats = SessionStats()
+
+
 class SessionMiddleware(MiddlewareMixin):
     """
     Middleware that provides ip and user_agent to the session store.
+
+    The store is created lazily, requests which never use request.session
+    cost neither a database query nor ip/user_agent processing.
     """
-    def process_request(self, request):
+
+    def __init__(self, get_response=None):
+        super(SessionMiddleware, self).__init__(get_response)
         engine = import_module(settings.SESSION_ENGINE)
-        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
-        request.session = engine.SessionStore(
+        self.SessionStore = engine.SessionStore
+        self.stats_interval = getattr(settings, 'SESSION_STATS_LOG_INTERVAL', None)
+
+    def process_request(self, request):
+        session_stats.incr('requests')
+        if self.stats_interval:
+            session_stats.log(self.stats_interval)
+        request.session = SimpleLazyObject(lambda: self.get_session_store(request))
+
+    def get_session_store(self, request):
+        session_stats.incr('touched')
+        return self.SessionStore(
             ip=request.META.get('REMOTE_ADDR', ''),
             user_agent=request.META.get('HTTP_USER_AGENT', ''),
-            session_key=session_key
+            session_key=request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
         )
 
-    def process_response(self, request, response):
+    def get_touched_session(self, request):
+        session = getattr(request, 'session', None)
+        if getattr(session, '_wrapped', None) is empty:
+            # The session was never used during this request.
+            return None
+        return session
+
+    def get_save_action(self, request, response):
         """
-        If request.session was modified, or if the configuration is to save the
-        session every time, save the changes and set a session cookie.
+        Returns 'save' if the session has to be saved with a refreshed cookie,
+        'metadata' if only ip/user_agent/last_activity are outdated and None
+        if there is nothing to write.
         """
         try:
             accessed = request.session.accessed
             modified = request.session.modified
         except AttributeError:
-            pass
+            return None
+        if accessed:
+            patch_vary_headers(response, ('Cookie',))
+        # Skip session save for 500 responses, refs #3881.
+        if response.status_code == 500:
+            return None
+        if modified or settings.SESSION_SAVE_EVERY_REQUEST:
+            return 'save'
+        if getattr(request.session, 'metadata_modified', False):
+            # No need to rewrite the session data or refresh the cookie.
+            return 'metadata'
+        return None
+
+    def set_session_cookie(self, request, response):
+        if request.session.get_expire_at_browser_close():
+            max_age = None
+            expires = None
         else:
-            if accessed:
-                patch_vary_headers(response, ('Cookie',))
-            if modified or settings.SESSION_SAVE_EVERY_REQUEST:
-                if request.session.get_expire_at_browser_close():
-                    max_age = None
-                    expires = None
-                else:
-                    max_age = request.session.get_expiry_age()
-                    expires_time = time.time() + max_age
-                    expires = http_date(expires_time)
-                # Save the session data and refresh the client cookie.
-                # Skip session save for 500 responses, refs #3881.
-                if response.status_code != 500:
-                    request.session.save()
-                    response.set_cookie(
-                        settings.SESSION_COOKIE_NAME,
-                        request.session.session_key,
-                        max_age=max_age,
-                        expires=expires,
-                        domain=settings.SESSION_COOKIE_DOMAIN,
-                        path=settings.SESSION_COOKIE_PATH,
-                        secure=settings.SESSION_COOKIE_SECURE or None,
-                        httponly=settings.SESSION_COOKIE_HTTPONLY or None)
+            max_age = request.session.get_expiry_age()
+            expires_time = time.time() + max_age
+            expires = http_date(expires_time)
+        response.set_cookie(
+            settings.SESSION_COOKIE_NAME,
+            request.session.session_key,
+            max_age=max_age,
+            expires=expires,
+            domain=settings.SESSION_COOKIE_DOMAIN,
+            path=settings.SESSION_COOKIE_PATH,
+            secure=settings.SESSION_COOKIE_SECURE or None,
+            httponly=settings.SESSION_COOKIE_HTTPONLY or None)
+
+    def count_save_action(self, action):
+        if action == 'save':
+            session_stats.incr('saved')
+        elif action == 'metadata':
+            session_stats.incr('metadata_saved')
+
+    def process_response(self, request, response):
+        """
+        If request.session was modified, or if the configuration is to save the
+        session every time, save the changes and set a session cookie.
+        """
+        if self.get_touched_session(request) is None:
+            return response
+        action = self.get_save_action(request, response)
+        if action == 'save':
+            # Save the session data and refresh the client cookie.
+            request.session.save()
+            self.set_session_cookie(request, response)
+        elif action == 'metadata':
+            request.session.save_metadata()
+        self.count_save_action(action)
         return response
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_auto_20200524_1415'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='city',
+            field=models.CharField(blank=True, max_length=128, null=True, verbose_name='City'),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='country',
+            field=models.CharField(blank=True, db_index=True, max_length=128, null=True, verbose_name='Country'),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='device_label',
+            field=models.CharField(blank=True, db_index=True, max_length=128, null=True, verbose_name='Device'),
+        ),
+    ]
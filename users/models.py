@@ -8,8 +8,6 @@ from phonenumber_field.modelfields import PhoneNumberField
 
 from internals.models import School, University
 
-from .templatetags.users import device, location
-
 
 SEX_CHOICES = [
     ('male', _('Male')),
@@ -119,7 +117,9 @@ class Session(models.Model):
     session ID -- not the data itself.
 
     Additionally this session object providers the following properties:
-    ``user``, ``user_agent`` and ``ip``.
+    ``user``, ``user_agent`` and ``ip``. ``country``, ``city`` and
+    ``device_label`` are derived from ``ip`` and ``user_agent`` when the
+    session is written.
     """
     class Meta:
         verbose_name = _('session')
@@ -133,11 +133,19 @@ class Session(models.Model):
     user_agent = models.CharField(null=True, blank=True, max_length=200)
     last_activity = models.DateTimeField(auto_now=True)
     ip = models.GenericIPAddressField(null=True, blank=True, verbose_name='IP')
+    country = models.CharField(max_length=128, null=True, blank=True, db_index=True, verbose_name=_('Country'))
+    city = models.CharField(max_length=128, null=True, blank=True, verbose_name=_('City'))
+    device_label = models.CharField(max_length=128, null=True, blank=True, db_index=True, verbose_name=_('Device'))
 
     objects = SessionManager()
 
     def __str__(self):
-        return f"Session {self.session_key} (User: {self.user}, Location: {location(self.ip)}, Device: {device(self.user_agent)}, Expires: {self.expire_date})"
+        return f"Session {self.session_key} (User: {self.user}, Location: {self.get_location()}, Device: {self.device_label}, Expires: {self.expire_date})"
+
+    def get_location(self):
+        if self.city:
+            return f"{self.city}, {self.country}"
+        return self.country
 
     def get_decoded(self):
         return SessionStore(None, None).decode(self.session_data)
@@ -1,8 +1,25 @@
-from import_export import resources
+from import_export import fields, widgets
 
-from .models import User
+from internals.models import University
+from internals.resources import BulkModelResource
 
+from .models import Parent, User
+
+
+class UserResource(BulkModelResource):
+    # Exported only, the student and profile of a user are edited inline.
+    student_university = fields.Field(
+        attribute='student__university', widget=widgets.ForeignKeyWidget(University), readonly=True
+    )
+    student_admission_year = fields.Field(attribute='student__admission_year', readonly=True)
+    profile_telegram_id = fields.Field(attribute='profile__telegram_id', readonly=True)
 
-class UserResource(resources.ModelResource):
     class Meta:
         model = User
+        # Declared fields come first otherwise.
+        export_order = tuple(field.name for field in User._meta.fields + User._meta.many_to_many)
+
+
+class ParentResource(BulkModelResource):
+    class Meta:
+        model = Parent
@@ -1,3 +1,214 @@
-from django.test import TestCase
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 
-# Create your tests here.
+from internals.exports import iter_rows
+from internals.models import School, University
+
+from .backends.cached_db import KEY_PREFIX, SessionStore, evict, get_shared_cache, local_cache
+from .middleware import SessionMiddleware, session_stats
+from .models import Parent, Profile, Session, Student, User
+from .resources import UserResource
+
+# One query for the users joined to their school, student and profile, and
+# one per many-to-many field: groups, user_permissions and parents.
+EXPORT_QUERIES = 4
+
+
+class UserExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.school = School.objects.create(full_name="School 1")
+        cls.university = University.objects.create(full_name="University", location="Mozyr", logo="logo.png")
+        cls.parents = [
+            Parent.objects.create(
+                sex='female', last_name="Ivanova", first_name=f"Anna {i}", job="Teacher", phone_number="+375291234567"
+            )
+            for i in range(2)
+        ]
+
+    def create_users(self, count):
+        start = User.objects.count()
+        for i in range(start, start + count):
+            user = User.objects.create_user(f"user{i}", phone_number="+375291234567", school=self.school)
+            user.parents.set(self.parents)
+            Student.objects.create(user=user, university=self.university, admission_year=2019)
+            Profile.objects.create(user=user, telegram_id=i)
+
+    def export(self):
+        return UserResource().export(User.objects.order_by('pk'))
+
+    def stream(self):
+        resource = UserResource()
+        return list(iter_rows(resource, User.objects.order_by('pk'), chunk_size=100))
+
+    def test_export_queries_dont_grow_with_rows(self):
+        self.create_users(2)
+        with self.assertNumQueries(EXPORT_QUERIES):
+            self.export()
+        self.create_users(20)
+        with self.assertNumQueries(EXPORT_QUERIES):
+            data = self.export()
+
+        self.assertEqual(len(data), 22)
+        row = data.dict[-1]
+        self.assertEqual(row['school'], self.school.pk)
+        self.assertEqual(row['parents'], ','.join(str(parent.pk) for parent in self.parents))
+        self.assertEqual(row['student_university'], self.university.pk)
+        self.assertEqual(row['student_admission_year'], '2019')
+        self.assertEqual(row['profile_telegram_id'], '21')
+
+    def test_streamed_export_queries_dont_grow_with_rows(self):
+        self.create_users(2)
+        with self.assertNumQueries(EXPORT_QUERIES):
+            self.stream()
+        self.create_users(20)
+        with self.assertNumQueries(EXPORT_QUERIES):
+            rows = self.stream()
+
+        self.assertEqual(len(rows), 22)
+        self.assertEqual(rows, [list(row) for row in self.export()])
+
+
+SESSION_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'sessions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'sessions'},
+}
+
+
+class CachedDBSessionMixin(object):
+    def setUp(self):
+        super(CachedDBSessionMixin, self).setUp()
+        local_cache.clear()
+        get_shared_cache().clear()
+
+    def create_session(self, user=None, **data):
+        store = SessionStore(ip='127.0.0.1', user_agent='tests')
+        store.update(data)
+        if user is not None:
+            store['_auth_user_id'] = str(user.pk)
+        store.save()
+        return store.session_key
+
+    def load(self, session_key):
+        store = SessionStore(session_key, ip='127.0.0.1', user_agent='tests')
+        store.load()
+        return store
+
+    def forget_local_cache(self):
+        # What another worker process sees: only the shared cache.
+        local_cache.clear()
+
+
+@override_settings(CACHES=SESSION_CACHES, SESSION_CACHE_ALIAS='sessions')
+class CachedDBSessionTests(CachedDBSessionMixin, TestCase):
+    def test_load_from_cache(self):
+        user = User.objects.create_user("user", phone_number="+375291234567")
+        session_key = self.create_session(user, counter=1)
+        for forget in (False, True):
+            if forget:
+                self.forget_local_cache()
+            with self.assertNumQueries(0):
+                store = self.load(session_key)
+            self.assertEqual(store['counter'], 1)
+            self.assertEqual(store.user_id, str(user.pk))
+            self.assertFalse(store.metadata_modified)
+
+    def test_load_from_database(self):
+        session_key = self.create_session(counter=1)
+        evict(session_key)
+        with self.assertNumQueries(1):
+            store = self.load(session_key)
+        self.assertEqual(store['counter'], 1)
+        # Cached again.
+        with self.assertNumQueries(0):
+            self.load(session_key)
+
+    def test_save(self):
+        session_key = self.create_session(counter=1)
+        store = self.load(session_key)
+        store['counter'] = 2
+        store.save()
+        self.assertEqual(self.load(session_key)['counter'], 2)
+        self.forget_local_cache()
+        self.assertEqual(self.load(session_key)['counter'], 2)
+        self.assertEqual(SessionStore().decode(Session.objects.get(pk=session_key).session_data)['counter'], 2)
+
+    def test_delete(self):
+        session_key = self.create_session(counter=1)
+        self.load(session_key).delete()
+        self.assertFalse(Session.objects.filter(pk=session_key).exists())
+        self.assertIsNone(local_cache.get(KEY_PREFIX + session_key))
+        self.assertIsNone(get_shared_cache().get(KEY_PREFIX + session_key))
+        store = self.load(session_key)
+        self.assertNotIn('counter', store)
+        self.assertNotEqual(store.session_key, session_key)
+
+    def test_evict(self):
+        session_key = self.create_session(counter=1)
+        Session.objects.filter(pk=session_key).update(session_data=SessionStore().encode({'counter': 2}))
+        self.assertEqual(self.load(session_key)['counter'], 1)
+        evict(session_key)
+        self.assertEqual(self.load(session_key)['counter'], 2)
+
+    def test_stale_local_record_is_not_used(self):
+        session_key = self.create_session(counter=1)
+        stale = local_cache.get(KEY_PREFIX + session_key)
+        # Another worker changes the session.
+        self.forget_local_cache()
+        store = self.load(session_key)
+        store['counter'] = 2
+        store.save()
+        local_cache.set(KEY_PREFIX + session_key, stale)
+
+        store = self.load(session_key)
+        self.assertEqual(store['counter'], 2)
+        store['other'] = True
+        store.save()
+        self.forget_local_cache()
+        store = self.load(session_key)
+        self.assertEqual((store['counter'], store['other']), (2, True))
+
+    def test_exists_checks_database(self):
+        session_key = self.create_session(counter=1)
+        self.assertTrue(SessionStore().exists(session_key))
+        Session.objects.filter(pk=session_key)._raw_delete('default')
+        self.assertFalse(SessionStore().exists(session_key))
+
+
+@override_settings(CACHES=SESSION_CACHES, SESSION_CACHE_ALIAS='sessions')
+class CachedDBSessionUserDeleteTests(CachedDBSessionMixin, TransactionTestCase):
+    def test_user_delete_evicts_sessions(self):
+        user = User.objects.create_user("user", phone_number="+375291234567")
+        session_key = self.create_session(user, counter=1)
+        other_key = self.create_session(counter=1)
+        user.delete()
+        self.assertIsNone(get_shared_cache().get(KEY_PREFIX + session_key))
+        store = self.load(session_key)
+        self.assertNotIn('counter', store)
+        self.assertEqual(self.load(other_key)['counter'], 1)
+
+
+@override_settings(CACHES=SESSION_CACHES, SESSION_CACHE_ALIAS='sessions', SESSION_STATS_LOG_INTERVAL=None)
+class SessionMiddlewareTests(TestCase):
+    def setUp(self):
+        session_stats.reset()
+
+    def get_response(self, request):
+        if request.path == '/session/':
+            request.session['counter'] = 1
+        return HttpResponse()
+
+    def test_stats(self):
+        middleware = SessionMiddleware(self.get_response)
+        factory = RequestFactory()
+        with self.assertNumQueries(0):
+            middleware(factory.get('/static/'))
+        response = middleware(factory.get('/session/'))
+        self.assertIn('sessionid', response.cookies)
+        self.assertEqual(session_stats.as_dict(), {'requests': 2, 'touched': 1, 'saved': 1})
+
+        with self.assertLogs('users.middleware', 'INFO') as logs:
+            session_stats.log(0)
+        self.assertEqual(logs.records[0].getMessage(), "Sessions: 2 requests, 1 touched (50%), 1 saved, 0 metadata saved")
+        with self.assertRaises(AssertionError), self.assertLogs('users.middleware', 'INFO'):
+            session_stats.log(60)
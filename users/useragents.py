@@ -0,0 +1,128 @@
+"""
+Single-pass, memoizing user agent classifier used by the ``device`` filter.
+
+``BROWSERS`` and ``DEVICES`` are ordered tables of (pattern, label), the
+first pattern of each table found anywhere in the user agent wins. Both
+tables are compiled into one alternation and the string is scanned once,
+the earliest table entry among the matches is the same as the one found by
+searching the patterns one after another. Matches don't overlap, so a
+pattern must not start inside the text matched by another one, which holds
+for the product tokens below.
+
+A few user agents make up most of the traffic, so results are kept in an
+LRU cache keyed on the raw string.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
+BROWSERS = (
+    ('Chrome', _('Chrome')),
+    ('Safari', _('Safari')),
+    ('Firefox', _('Firefox')),
+    ('Opera', _('Opera')),
+    ('IE', _('Internet Explorer')),
+)
+# Safari and Chrome freeze the macOS version at 10_15_7 and Windows 11
+# reports itself as NT 10.0, those can only be told apart by client hints.
+DEVICES = (
+    ('Android', _('Android')),
+    ('Linux', _('Linux')),
+    ('iPhone', _('iPhone')),
+    ('iPad', _('iPad')),
+    ('Mac OS X 10[._]9', _('OS X Mavericks')),
+    ('Mac OS X 10[._]10', _('OS X Yosemite')),
+    ('Mac OS X 10[._]11', _('OS X El Capitan')),
+    ('Mac OS X 10[._]12', _('macOS Sierra')),
+    ('Mac OS X 10[._]13', _('macOS High Sierra')),
+    ('Mac OS X 10[._]14', _('macOS Mojave')),
+    ('Mac OS X 10[._]15', _('macOS Catalina')),
+    ('Mac OS X 11[._]', _('macOS Big Sur')),
+    ('Mac OS X 12[._]', _('macOS Monterey')),
+    ('Mac OS X 13[._]', _('macOS Ventura')),
+    ('Mac OS X 14[._]', _('macOS Sonoma')),
+    ('Mac OS X', _('OS X')),
+    ('NT 5.1', _('Windows XP')),
+    ('NT 6.0', _('Windows Vista')),
+    ('NT 6.1', _('Windows 7')),
+    ('NT 6.2', _('Windows 8')),
+    ('NT 6.3', _('Windows 8.1')),
+    ('NT 10.0', _('Windows 10')),
+    ('Windows', _('Windows')),
+)
+
+
+class UserAgentClassifier(object):
+    """
+    Classifies user agents into (browser, device) label tuples.
+    """
+    def __init__(self, browsers=BROWSERS, devices=DEVICES, cache_size=10000):
+        self.tables = (browsers, devices)
+        self.patterns = [
+            (i, j, re.compile(pattern))
+            for i, table in enumerate(self.tables)
+            for j, (pattern, label) in enumerate(table)
+        ]
+        # Capturing groups would disable the literal prefix optimizations of
+        # the regex engine, matched strings are mapped back to patterns.
+        self.regex = re.compile('|'.join(f'(?:{regex.pattern})' for i, j, regex in self.patterns))
+        self._matches = {}
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _identify(self, text):
+        # The alternative the scan picked is the first one matching the text
+        # as a whole, otherwise an earlier one would have matched before it.
+        for i, j, regex in self.patterns:
+            if regex.fullmatch(text):
+                return i, j
+
+    def _classify(self, value):
+        found = [len(table) for table in self.tables]
+        for text in self.regex.findall(value):
+            try:
+                i, j = self._matches[text]
+            except KeyError:
+                i, j = self._matches[text] = self._identify(text)
+            if j < found[i]:
+                found[i] = j
+        return tuple(
+            table[index][1] if index < len(table) else None
+            for table, index in zip(self.tables, found)
+        )
+
+    def classify_many(self, values):
+        """
+        Classifies a sequence of user agents, each distinct string once.
+        """
+        results = {}
+        for value in values:
+            if value not in results:
+                results[value] = self.classify(value) if value else (None, None)
+        return [results[value] for value in values]
+
+    def label(self, value):
+        """
+        Returns a human readable label like "Safari on iPhone", or None.
+        """
+        return format_label(*self.classify(value)) if value else None
+
+
+def format_label(browser, device):
+    if browser and device:
+        return _('%(browser)s on %(device)s') % {
+            'browser': browser,
+            'device': device
+        }
+    return browser or device
+
+
+classifier = UserAgentClassifier(cache_size=getattr(settings, 'USER_AGENT_CACHE_SIZE', 10000))
+
+
+def labels(values):
+    """
+    Transforms a sequence of user agents into a list of labels.
+    """
+    return [format_label(*result) for result in classifier.classify_many(values)]
@@ -5,11 +5,14 @@ from simple_history.admin import SimpleHistoryAdmin
 from import_export.admin import ImportExportActionModelAdmin
 from adminsortable2.admin import SortableAdminMixin
 
+from internals.exports import BackgroundExportMixin
+from internals.resources import BulkImportMixin
+
 from .models import HallOfFameMember
 
 
 @admin.register(HallOfFameMember)
-class HallOfFameMemberAdmin(SortableAdminMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
+class HallOfFameMemberAdmin(SortableAdminMixin, BulkImportMixin, BackgroundExportMixin, ImportExportActionModelAdmin, SimpleHistoryAdmin):
     list_display = ('full_name', 'achievement', 'order')
     autocomplete_fields = ('user',)
 